@@ -0,0 +1,191 @@
+"""End-to-end inference benchmark of the ACT policy across backends.
+
+Sweeps batch size and camera-history length and runs eager PyTorch,
+TorchScript, torch.compile, ONNX Runtime and TensorRT side by side on the same
+inputs. Reports mean/p50/p99 latency, throughput and peak memory per
+configuration, and writes the results as JSON so releases can be compared.
+Runs on CPU-only hosts too, where the tensorrt backend is skipped.
+
+    python benchmark_trt.py --checkpoint ckpts/policy_last.pt --batch-sizes 1 8 \
+        --num-cameras 1 5 10 --backends eager torchscript onnxruntime tensorrt --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from detr.export import example_inputs, export_checkpoint, export_policy, load_policy
+
+BACKENDS = ("eager", "torchscript", "compile", "onnxruntime", "tensorrt")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=None, help="ACTPolicy state dict; random weights when omitted")
+    parser.add_argument("--onnx", default=None,
+                        help="ONNX model for the onnxruntime and tensorrt backends, for a single configuration; "
+                             "exported per configuration when omitted")
+    parser.add_argument("--engine", default=None,
+                        help="prebuilt TensorRT engine for the tensorrt backend, e.g. from a build_engines.py "
+                             "manifest, for a single configuration")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1])
+    parser.add_argument("--num-cameras", nargs="+", type=int, default=[10])
+    parser.add_argument("--height", type=int, default=180)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--precision", default=None, choices=["fp32", "fp16", "int8"],
+                        help="TensorRT precision; defaults to the fastest the platform supports")
+    parser.add_argument("--engine-cache-dir", default="~/.cache/trt_engines")
+    parser.add_argument("--work-dir", default="benchmark_models", help="where per-configuration ONNX exports go")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    args = parser.parse_args()
+    if (args.onnx is not None or args.engine is not None) and len(args.batch_sizes) * len(args.num_cameras) > 1:
+        parser.error("--onnx and --engine are built for one input shape; pass a single --batch-sizes and "
+                     "--num-cameras with them")
+    return args
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def onnx_model(policy, inputs, args, num_cameras, batch_size):
+    """
+    --onnx, or the export of the benchmarked policy for one configuration. Checkpoint exports are keyed on
+    the checkpoint contents and the model configuration, so a stale export is never reused.
+    """
+    if args.onnx is not None:
+        return args.onnx
+    device = inputs[0].device.type
+    if args.checkpoint is not None:
+        return export_checkpoint(args.checkpoint, args.work_dir, num_cameras, batch_size, args.height, args.width,
+                                 device=device, policy=policy)
+    # random weights differ between runs, so they are exported every time
+    os.makedirs(args.work_dir, exist_ok=True)
+    path = os.path.join(args.work_dir, "random_c{}_b{}_{}x{}.onnx".format(num_cameras, batch_size, args.height,
+                                                                          args.width))
+    export_policy(policy, path, inputs)
+    return path
+
+
+def make_runner(backend, policy, inputs, args, num_cameras, batch_size):
+    """A callable running one inference step on inputs, and its startup time in seconds."""
+    start = time.perf_counter()
+    if backend == "eager":
+        runner = lambda: policy(*inputs)
+    elif backend == "torchscript":
+        module = torch.jit.freeze(torch.jit.trace(policy, inputs))
+        runner = lambda: module(*inputs)
+    elif backend == "compile":
+        module = torch.compile(policy)
+        runner = lambda: module(*inputs)
+    elif backend == "onnxruntime":
+        from maskclip_onnx.providers import prepare
+
+        rep = prepare(onnx_model(policy, inputs, args, num_cameras, batch_size), provider="onnxruntime")
+        runner = lambda: rep.run(inputs, "torch_cuda")
+    elif backend == "tensorrt":
+        from maskclip_onnx.providers import prepare
+
+        if args.engine is not None:
+            rep = prepare(args.onnx, provider="tensorrt", device="CUDA:0", engine_path=args.engine)
+        else:
+            rep = prepare(onnx_model(policy, inputs, args, num_cameras, batch_size), provider="tensorrt",
+                          device="CUDA:0", precision=args.precision, engine_cache_dir=args.engine_cache_dir)
+        runner = lambda: rep.run(inputs, "torch_cuda")
+    else:
+        raise ValueError("Unknown backend %s" % backend)
+    return runner, time.perf_counter() - start
+
+
+def benchmark(runner, batch_size, warmup, iters):
+    cuda = torch.cuda.is_available()
+    for _ in range(warmup):
+        runner()
+    synchronize()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+    latencies = np.empty(iters)
+    start = time.perf_counter()
+    for i in range(iters):
+        step_start = time.perf_counter()
+        runner()
+        synchronize()
+        latencies[i] = time.perf_counter() - step_start
+    total = time.perf_counter() - start
+    latencies *= 1e3
+    result = OrderedDict([
+        ("latency_ms_mean", float(latencies.mean())),
+        ("latency_ms_p50", float(np.percentile(latencies, 50))),
+        ("latency_ms_p99", float(np.percentile(latencies, 99))),
+        ("throughput", batch_size * iters / total),
+        ("torch_peak_mb", None),
+        ("device_used_mb", None),
+    ])
+    if cuda:
+        free, device_total = torch.cuda.mem_get_info()
+        # TensorRT allocates outside the torch caching allocator, so both views are reported
+        result["torch_peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        result["device_used_mb"] = (device_total - free) / 2**20
+    return result
+
+
+def environment():
+    env = OrderedDict([
+        ("host", platform.node()),
+        ("python", platform.python_version()),
+        ("torch", torch.__version__),
+        ("gpu", torch.cuda.get_device_name() if torch.cuda.is_available() else None),
+    ])
+    try:
+        import tensorrt
+
+        env["tensorrt"] = tensorrt.__version__
+    except ImportError:
+        env["tensorrt"] = None
+    return env
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    backends = list(args.backends)
+    if device == "cpu" and "tensorrt" in backends:
+        print("No CUDA device, skipping the tensorrt backend")
+        backends.remove("tensorrt")
+    results = []
+    print("backend      cams  batch   mean ms    p50 ms    p99 ms   samples/s  startup s")
+    with torch.no_grad():
+        for num_cameras in args.num_cameras:
+            policy = load_policy(args.checkpoint, num_cameras, device)
+            for batch_size in args.batch_sizes:
+                inputs = example_inputs(batch_size, num_cameras, args.height, args.width, device)
+                for backend in backends:
+                    runner, startup = make_runner(backend, policy, inputs, args, num_cameras, batch_size)
+                    row = OrderedDict([("backend", backend), ("num_cameras", num_cameras),
+                                       ("batch_size", batch_size), ("startup_s", startup)])
+                    row.update(benchmark(runner, batch_size, args.warmup, args.iters))
+                    results.append(row)
+                    print("{:11}  {:4}  {:5}  {:8.3f}  {:8.3f}  {:8.3f}  {:10.1f}  {:9.2f}".format(
+                        backend, num_cameras, batch_size, row["latency_ms_mean"], row["latency_ms_p50"],
+                        row["latency_ms_p99"], row["throughput"], startup))
+                    del runner
+            del policy
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(OrderedDict([("environment", environment()), ("args", vars(args)), ("results", results)]),
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
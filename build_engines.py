@@ -0,0 +1,171 @@
+"""Offline build of TensorRT engines for a matrix of policy variants.
+
+Every combination of checkpoint, precision, batch size and camera-history
+length is exported to ONNX and built into the engine cache by a pool of worker
+processes, each with its own CUDA context and TensorRT builder. Exports are
+keyed on the checkpoint contents and the graph options, so retraining a
+checkpoint in place re-exports it. A JSON manifest maps every variant to its
+engine cache key, engine file, size and build time, so deployments can look
+engines up without rebuilding.
+
+    python build_engines.py --checkpoints ckpts/policy_last.pt --precisions fp32 fp16 int8 \
+        --batch-sizes 1 16 --num-cameras 5 10 --calibration-dataset-dirs data/parkour --workers 2
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoints", nargs="+", required=True, help="ACTPolicy state dicts")
+    parser.add_argument("--precisions", nargs="+", default=["fp16"], choices=["fp32", "fp16", "int8"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1])
+    parser.add_argument("--num-cameras", nargs="+", type=int, default=[10])
+    parser.add_argument("--height", type=int, default=180)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--freeze", action="store_true", help="export with ACTPolicy.freeze_for_inference")
+    parser.add_argument("--uint8-input", action="store_true",
+                        help="export with the input normalization folded in and a uint8 image input")
+    parser.add_argument("--output-layer", type=int, default=0, help="ACTArgs.output_layer of the exported decoder")
+    parser.add_argument("--engine-cache-dir", default="~/.cache/trt_engines")
+    parser.add_argument("--work-dir", default="engine_builds", help="where ONNX exports and calibration caches go")
+    parser.add_argument("--manifest", default=None, help="defaults to manifest.json in the engine cache")
+    parser.add_argument("--calibration-dataset-dirs", nargs="+", default=None, help="episodes for INT8 calibration")
+    parser.add_argument("--max-workspace-size", type=int, default=1 << 30)
+    parser.add_argument("--workers", type=int, default=2, help="concurrent builder processes")
+    return parser.parse_args()
+
+
+def variant_name(variant):
+    checkpoint = os.path.splitext(os.path.basename(variant["checkpoint"]))[0]
+    name = "{}_c{}_b{}_{}x{}_{}".format(checkpoint, variant["num_cameras"], variant["batch_size"],
+                                        variant["height"], variant["width"], variant["precision"])
+    if variant["freeze"]:
+        name += "_frozen"
+    if variant["uint8_input"]:
+        name += "_uint8"
+    if variant["output_layer"]:
+        name += "_layer{}".format(variant["output_layer"])
+    return name
+
+
+def export_variant(variant, work_dir, engine_cache_dir):
+    """
+    Export the checkpoint to ONNX with the variant's input shapes and graph options. Variants differing only in
+    precision share the export, which is reused until the checkpoint contents or the options change.
+    """
+    from detr.export import export_checkpoint
+    from detr.policy import ACTArgs
+    from maskclip_onnx.engine_cache import EngineCache
+
+    # spawned workers start from the ACTArgs defaults
+    ACTArgs.output_layer = variant["output_layer"]
+    return export_checkpoint(
+        variant["checkpoint"],
+        work_dir,
+        variant["num_cameras"],
+        variant["batch_size"],
+        variant["height"],
+        variant["width"],
+        checkpoint_digest=EngineCache(engine_cache_dir).model_digest(variant["checkpoint"]),
+        freeze=variant["freeze"],
+        uint8_input=variant["uint8_input"],
+    )
+
+
+def build_variant(variant, args):
+    """Worker: export and build one variant. Runs in its own process with its own CUDA context."""
+    start = time.perf_counter()
+    result = OrderedDict([("name", variant_name(variant))])
+    result.update(variant)
+    try:
+        onnx_path = export_variant(variant, args["work_dir"], args["engine_cache_dir"])
+        export_time = time.perf_counter() - start
+
+        from maskclip_onnx.onnx_tensorrt import TensorRTBackendRep
+
+        kwargs = {}
+        if variant["precision"] == "int8":
+            if not args["calibration_dataset_dirs"]:
+                raise ValueError("INT8 variants need --calibration-dataset-dirs")
+            from maskclip_onnx.calibration import episode_calibrator
+
+            cache_file = os.path.splitext(onnx_path)[0] + ".calib"
+            kwargs["int8_calibrator"] = episode_calibrator(args["calibration_dataset_dirs"], cache_file,
+                                                           variant["num_cameras"], batch_size=variant["batch_size"],
+                                                           uint8=variant["uint8_input"])
+        rep = TensorRTBackendRep(onnx_path, "CUDA:0", engine_cache_dir=args["engine_cache_dir"],
+                                 precision=variant["precision"], max_workspace_size=args["max_workspace_size"],
+                                 **kwargs)
+        engine_path = rep.engine_cache.path(rep.engine_cache_key)
+        result.update([
+            ("onnx", os.path.abspath(onnx_path)),
+            ("key", rep.engine_cache_key),
+            ("engine", engine_path),
+            ("engine_mb", os.path.getsize(engine_path) / 2**20),
+            ("export_s", export_time),
+            ("build_s", rep.startup_times.get("build", 0.0)),
+            ("total_s", time.perf_counter() - start),
+            ("cached", "build" not in rep.startup_times),
+        ])
+    except Exception:
+        result["error"] = traceback.format_exc()
+    return result
+
+
+def main():
+    args = parse_args()
+    engine_cache_dir = os.path.abspath(os.path.expanduser(args.engine_cache_dir))
+    manifest_path = args.manifest or os.path.join(engine_cache_dir, "manifest.json")
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.makedirs(engine_cache_dir, exist_ok=True)
+    worker_args = {
+        "work_dir": os.path.abspath(args.work_dir),
+        "engine_cache_dir": engine_cache_dir,
+        "calibration_dataset_dirs": args.calibration_dataset_dirs,
+        "max_workspace_size": args.max_workspace_size,
+    }
+    variants = [OrderedDict([("checkpoint", os.path.abspath(checkpoint)), ("precision", precision),
+                             ("batch_size", batch_size), ("num_cameras", num_cameras),
+                             ("height", args.height), ("width", args.width), ("freeze", args.freeze),
+                             ("uint8_input", args.uint8_input), ("output_layer", args.output_layer)])
+                for checkpoint, precision, batch_size, num_cameras in itertools.product(
+                    args.checkpoints, args.precisions, args.batch_sizes, args.num_cameras)]
+    print("Building {} variants with {} workers".format(len(variants), args.workers))
+
+    manifest = OrderedDict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f, object_pairs_hook=OrderedDict)
+    start = time.perf_counter()
+    failed = 0
+    # spawn, not fork: CUDA cannot be used in a forked child of a process that initialized it
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(build_variant, variant, worker_args) for variant in variants]
+        for future in as_completed(futures):
+            result = future.result()
+            if "error" in result:
+                failed += 1
+                print("FAILED {}\n{}".format(result["name"], result["error"]))
+                continue
+            manifest[result["name"]] = result
+            print("{:48} {:8.1f} s {:8.1f} MB{}".format(result["name"], result["build_s"], result["engine_mb"],
+                                                        " (cached)" if result["cached"] else ""))
+            # written after every variant so a crash does not lose the finished ones
+            tmp_path = manifest_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, manifest_path)
+    print("Built {} of {} variants in {:.1f} s, manifest: {}".format(
+        len(variants) - failed, len(variants), time.perf_counter() - start, manifest_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Numerical parity of TensorRT engines against the PyTorch ACT policy.
+
+Runs ACTPolicy and an engine per requested precision on observations recorded
+in episode_*.hdf5 datasets, reports the error distribution of every output and
+every action dimension, and recommends the fastest precision within tolerance.
+
+    python check_parity.py --checkpoint ckpts/policy_last.pt --onnx ckpts/policy.onnx \
+        --dataset-dirs data/parkour --num-cameras 10 --precisions fp32 fp16 int8 \
+        --calibration-cache ckpts/policy.calib --output parity.json
+"""
+import argparse
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from detr.policy import get_n_act_policy
+from detr.utils import get_norm_stats_combined, iterate_calibration_batches
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", required=True, help="ACTPolicy state dict")
+    parser.add_argument("--onnx", required=True, help="ONNX export of the same checkpoint")
+    parser.add_argument("--dataset-dirs", nargs="+", required=True, help="directories with episode_*.hdf5 files")
+    parser.add_argument("--num-cameras", type=int, default=10)
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "fp16"], choices=["fp32", "fp16", "int8"])
+    parser.add_argument("--num-samples", type=int, default=256, help="number of recorded observations")
+    parser.add_argument("--batch-size", type=int, default=1, help="batch size the engine was exported with")
+    parser.add_argument("--p99-tol", type=float, default=1e-2, help="budget on the p99 absolute error")
+    parser.add_argument("--max-tol", type=float, default=5e-2, help="budget on the maximum absolute error")
+    parser.add_argument("--calibration-cache", default=None, help="INT8 calibration cache, required for int8")
+    parser.add_argument("--engine-cache-dir", default=None)
+    parser.add_argument("--timing-iters", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    return parser.parse_args()
+
+
+def error_stats(errors):
+    """Distribution of absolute errors, flattened."""
+    errors = errors.reshape(-1)
+    return OrderedDict([
+        ("mean", float(errors.mean())),
+        ("p50", float(np.percentile(errors, 50))),
+        ("p99", float(np.percentile(errors, 99))),
+        ("max", float(errors.max())),
+    ])
+
+
+def per_dim_stats(errors):
+    """p99 and max absolute error of every entry of the last dimension, e.g. every joint of the action."""
+    errors = errors.reshape(-1, errors.shape[-1])
+    return OrderedDict([
+        ("p99", np.percentile(errors, 99, axis=0).tolist()),
+        ("max", errors.max(axis=0).tolist()),
+    ])
+
+
+def time_engine(rep, inputs, iterations):
+    for _ in range(10):
+        rep.run(inputs, "torch_cuda")
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        rep.run(inputs, "torch_cuda")
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations * 1e3
+
+
+def main():
+    args = parse_args()
+    from maskclip_onnx.providers import prepare
+
+    with torch.no_grad():
+        policy = get_n_act_policy(args.num_cameras)
+        print(policy.load_state_dict(torch.load(args.checkpoint, map_location="cuda")))
+        policy.eval().cuda()
+
+        norm_stats = get_norm_stats_combined(args.dataset_dirs)
+        num_batches = max(1, args.num_samples // args.batch_size)
+        batches = [(torch.from_numpy(image).cuda(), torch.from_numpy(qpos).cuda())
+                   for image, qpos in iterate_calibration_batches(args.dataset_dirs, args.num_cameras, norm_stats,
+                                                                  args.batch_size, num_batches, args.seed)]
+        references = [policy(*batch) for batch in batches]
+        if isinstance(references[0], torch.Tensor):
+            references = [(reference,) for reference in references]
+
+        report = OrderedDict()
+        for precision in args.precisions:
+            kwargs = {}
+            if precision == "int8":
+                if args.calibration_cache is None:
+                    raise SystemExit("--calibration-cache is required for int8")
+                from maskclip_onnx.calibration import episode_calibrator
+
+                # calibrate on other episodes than the ones compared against
+                kwargs["int8_calibrator"] = episode_calibrator(args.dataset_dirs, args.calibration_cache,
+                                                               args.num_cameras, batch_size=args.batch_size,
+                                                               norm_stats=norm_stats, seed=args.seed + 1)
+            rep = prepare(args.onnx, provider="tensorrt", device="CUDA:0", precision=precision,
+                          engine_cache_dir=args.engine_cache_dir, **kwargs)
+            errors = None
+            for batch, reference in zip(batches, references):
+                outputs = rep.run(batch, "torch_cuda")
+                batch_errors = [(output.float() - expected.float()).abs().cpu().numpy()
+                                for output, expected in zip(outputs, reference)]
+                if errors is None:
+                    errors = [[] for _ in batch_errors]
+                for collected, error in zip(errors, batch_errors):
+                    collected.append(error)
+            outputs_report = OrderedDict()
+            within_budget = True
+            for name, collected in zip(outputs._fields, errors):
+                collected = np.concatenate(collected)
+                stats = error_stats(collected)
+                within_budget &= stats["p99"] <= args.p99_tol and stats["max"] <= args.max_tol
+                outputs_report[name] = OrderedDict([("error", stats), ("per_dim", per_dim_stats(collected))])
+            report[precision] = OrderedDict([
+                ("latency_ms", time_engine(rep, batches[0], args.timing_iters)),
+                ("within_budget", bool(within_budget)),
+                ("outputs", outputs_report),
+            ])
+            del rep
+
+    print("precision  latency ms  within budget  output: p99 / max abs error")
+    for precision, result in report.items():
+        errors = ", ".join("{}: {:.2e} / {:.2e}".format(name, o["error"]["p99"], o["error"]["max"])
+                           for name, o in result["outputs"].items())
+        print("{:9}  {:10.3f}  {:13}  {}".format(precision, result["latency_ms"], str(result["within_budget"]), errors))
+    candidates = [p for p, result in report.items() if result["within_budget"]]
+    recommended = min(candidates, key=lambda p: report[p]["latency_ms"]) if candidates else None
+    if recommended is None:
+        print("No precision stays within p99 {} / max {}".format(args.p99_tol, args.max_tol))
+    else:
+        print("Recommended precision: {}".format(recommended))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(OrderedDict([("tolerance", {"p99": args.p99_tol, "max": args.max_tol}),
+                                   ("recommended", recommended), ("precisions", report)]), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
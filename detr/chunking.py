@@ -0,0 +1,84 @@
+"""
+Action chunk execution.
+
+The policy predicts num_queries future actions per call. ActionChunkExecutor queries it every
+query_interval control steps only and serves one action per step from the chunks it keeps on the
+device: from the newest chunk, or with temporal ensembling, the exponentially weighted average of every
+chunk that predicts the current step, as in ACT.
+"""
+
+import torch
+
+from detr.policy import ACTArgs
+
+
+class ActionChunkExecutor:
+    """
+    policy: ACTPolicy, or any callable (image, qpos) -> actions of batch, num_queries, action_dim, e.g. a
+        TensorRT engine wrapped to return its action output
+    query_interval: control steps between policy queries, from 1 to num_queries; ACTArgs.query_interval when None
+    temporal_agg: ensemble the overlapping chunks instead of following the newest; ACTArgs.temporal_agg when None
+    decay: weight exp(-decay * i) of the i-th oldest chunk, so positive values favour older chunks like ACT
+        does; ACTArgs.temporal_agg_decay when None
+    """
+
+    def __init__(self, policy, query_interval=None, temporal_agg=None, decay=None):
+        self.policy = policy
+        self.query_interval = ACTArgs.query_interval if query_interval is None else query_interval
+        self.temporal_agg = ACTArgs.temporal_agg if temporal_agg is None else temporal_agg
+        self.decay = ACTArgs.temporal_agg_decay if decay is None else decay
+        if self.query_interval < 1:
+            raise ValueError(f"query_interval must be at least 1, got {self.query_interval}")
+
+        self.chunks = None  # batch, slots, num_queries, action_dim
+        self.starts = None  # control step at which the chunk of every slot was predicted
+        self._slot_index = None
+        self.slot = 0
+        self.t = 0
+
+    @property
+    def chunk_size(self):
+        return None if self.chunks is None else self.chunks.shape[2]
+
+    def reset(self):
+        """Forgets all chunks, e.g. at the start of an episode."""
+        self.t = 0
+        self.slot = 0
+        if self.starts is not None:
+            self.starts.fill_(-self.chunk_size)
+
+    def _store(self, chunk):
+        bs, chunk_size, action_dim = chunk.shape
+        if self.query_interval > chunk_size:
+            raise ValueError(f"query_interval {self.query_interval} exceeds the chunk size {chunk_size}")
+        # a chunk stops predicting the current step chunk_size steps after its query
+        num_slots = -(-chunk_size // self.query_interval) if self.temporal_agg else 1
+        shape = (bs, num_slots, chunk_size, action_dim)
+        if self.chunks is None or self.chunks.shape != shape or self.chunks.device != chunk.device:
+            self.chunks = torch.zeros(shape, dtype=chunk.dtype, device=chunk.device)
+            self.starts = torch.empty(num_slots, dtype=torch.long, device=chunk.device)
+            self._slot_index = torch.arange(num_slots, device=chunk.device)
+            self.reset()
+        self.chunks[:, self.slot].copy_(chunk)
+        self.starts[self.slot].fill_(self.t)
+        self.slot = (self.slot + 1) % num_slots
+
+    @torch.no_grad()
+    def step(self, image, qpos):
+        """
+        Queries the policy when due and returns the action of the current control step, batch, action_dim.
+        image and qpos are only used on query steps.
+        """
+        if self.t % self.query_interval == 0:
+            self._store(self.policy(image, qpos))
+        # steps since every chunk was predicted; empty slots are chunk_size or more behind
+        offsets = self.t - self.starts
+        valid = offsets < self.chunk_size
+        actions = self.chunks[:, self._slot_index, offsets.clamp(max=self.chunk_size - 1)]  # batch, slots, action_dim
+        self.t += 1
+        if not self.temporal_agg:
+            return actions[:, 0]
+        # exp(-decay * i) of the i-th oldest chunk, i.e. exp(decay * queries since the chunk), normalized
+        logits = (offsets * (self.decay / self.query_interval)).masked_fill(~valid, float("-inf"))
+        weights = logits.softmax(0).to(actions.dtype)
+        return (actions * weights[None, :, None]).sum(1)
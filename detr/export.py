@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+import onnx
+import torch
+from params_proto import ParamsProto
+
+from detr.policy import ACTArgs, act_args_preset, get_n_act_policy
+
+INPUT_NAMES = ["ego_view", "obs_input"]
+OUTPUT_NAMES = ["actions"]
+OBS_DIM = 753
+# ACTArgs that change the exported graph, see export_key
+GRAPH_ACT_ARGS = ("backbone", "hidden_dim", "dim_feedforward", "enc_layers", "dec_layers", "nheads", "num_queries", "pre_norm", "output_layer")
+
+
+class ExportArgs(ParamsProto):
+    checkpoint: str = None  # ACTPolicy state dict; random weights when None
+    onnx_path = "policy.onnx"
+
+    num_cameras = 10
+    batch_size = 1
+    height = 180
+    width = 320
+
+    opset = 17
+    dynamic_batch = False
+    dynamic_cameras = False
+    # folding merges e.g. BatchNorm into convolutions; refittable engines cannot refit folded weights
+    constant_folding = True
+    # ACTPolicy.freeze_for_inference before export; the frozen weights no longer match the training state dict
+    freeze = False
+    # fold the ImageNet normalization into conv1; with uint8_input the model takes uint8 images in [0, 255]
+    fold_normalization = False
+    uint8_input = False
+    # graph rewrites of maskclip_onnx.onnx_optimize; LayerNormalization nodes need TensorRT 8.6+
+    optimize = False
+    fuse_layer_norm = False
+    # export the frame encoder and history decoder of detr.streaming next to onnx_path instead
+    streaming = False
+
+    validate = True
+    atol = 1e-4
+    device = "cpu"
+
+
+def example_inputs(batch_size, num_cameras, height, width, device="cpu", uint8=False):
+    if uint8:
+        ego_view = torch.randint(0, 256, (batch_size, num_cameras, 3, height, width), dtype=torch.uint8, device=device)
+    else:
+        ego_view = torch.rand(batch_size, num_cameras, 3, height, width, device=device)
+    obs_input = torch.randn(batch_size, OBS_DIM, device=device)
+    return ego_view, obs_input
+
+
+def dynamic_axes(dynamic_batch=False, dynamic_cameras=False, names=INPUT_NAMES + OUTPUT_NAMES):
+    axes = {name: {} for name in names}
+    if dynamic_batch:
+        for name in names:
+            axes[name][0] = "batch"
+    if dynamic_cameras:
+        axes["ego_view"][1] = "cameras"
+    return {name: axis for name, axis in axes.items() if axis} or None
+
+
+def export_policy(policy, onnx_path, inputs, opset=17, dynamic_batch=False, dynamic_cameras=False, constant_folding=True,
+                  input_names=INPUT_NAMES, output_names=OUTPUT_NAMES):
+    """
+    Exports an ACTPolicy to ONNX with named inputs (ego_view, obs_input) and output (actions),
+    then runs ONNX shape inference so every intermediate tensor has a static or symbolic shape.
+    Other policy modules, e.g. the halves of detr.streaming, pass their own input and output names.
+    """
+    if dynamic_cameras and not getattr(policy.model, "supports_dynamic_cameras", False):
+        raise NotImplementedError(f"{type(policy.model).__name__} does not support a dynamic camera axis")
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    # newer torch defaults to the dynamo exporter, which does not take dynamic_axes
+    legacy = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            policy,
+            inputs,
+            onnx_path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes(dynamic_batch, dynamic_cameras, input_names + output_names),
+            opset_version=opset,
+            do_constant_folding=constant_folding,
+            export_params=True,
+            **legacy,
+        )
+    model = onnx.load(onnx_path)
+    onnx.checker.check_model(model)
+    model = onnx.shape_inference.infer_shapes(model, strict_mode=True)
+    onnx.save(model, onnx_path)
+    return model
+
+
+def validate_onnx(policy, onnx_path, inputs, atol=1e-4):
+    """
+    Runs the exported model with ONNX Runtime on CPU and compares it against the PyTorch policy.
+    Returns the maximum absolute error.
+    """
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+    with torch.no_grad():
+        expected = policy(*inputs).cpu().numpy()
+    (actions,) = session.run(OUTPUT_NAMES, {name: x.cpu().numpy() for name, x in zip(INPUT_NAMES, inputs)})
+    max_err = float(np.abs(actions - expected).max())
+    print(f"ONNX Runtime vs PyTorch max abs error: {max_err:.3e}")
+    if max_err > atol:
+        raise AssertionError(f"Exported model differs from PyTorch by {max_err:.3e} > {atol:.1e}")
+    return max_err
+
+
+def load_policy(checkpoint, num_cameras, device="cpu", freeze=False, fold_normalization=False, uint8_input=False):
+    """ACTPolicy with the weights of checkpoint (random weights when None), in eval mode and specialized for export."""
+    policy = get_n_act_policy(num_cameras)
+    if checkpoint is not None:
+        print(policy.load_state_dict(torch.load(checkpoint, map_location=device)))
+    policy.eval().to(device)
+    if freeze:
+        policy.freeze_for_inference()
+    if fold_normalization or uint8_input:
+        policy.fold_input_normalization(uint8=uint8_input)
+    return policy
+
+
+def export_key(checkpoint_digest, **options):
+    """
+    sha256 of everything an exported graph depends on: the checkpoint contents, the export options and the
+    ACTArgs get_n_act_policy builds the model with.
+    """
+    act_args = {name: act_args_preset.get(name, getattr(ACTArgs, name)) for name in GRAPH_ACT_ARGS}
+    payload = {"checkpoint": checkpoint_digest, "act_args": act_args, "options": options}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def export_checkpoint(checkpoint, onnx_dir, num_cameras, batch_size=1, height=180, width=320, checkpoint_digest=None,
+                      freeze=False, fold_normalization=False, uint8_input=False, opset=17, device="cpu", policy=None):
+    """
+    Exports a checkpoint into onnx_dir once per export_key, so an existing export is only reused when the
+    checkpoint contents and the graph configuration are unchanged. Concurrent callers, e.g. the workers
+    of build_engines.py, wait on a file lock for the one exporting.
+    Args:
+        checkpoint_digest: sha256 of the checkpoint, e.g. EngineCache.model_digest; hashed when None
+        policy: the already loaded policy of checkpoint, specialized with the same options, exported
+            instead of loading the checkpoint again
+    Returns the path of the ONNX model.
+    """
+    if checkpoint_digest is None:
+        from maskclip_onnx.engine_cache import hash_file
+
+        checkpoint_digest = hash_file(checkpoint)
+    key = export_key(
+        checkpoint_digest,
+        num_cameras=num_cameras,
+        batch_size=batch_size,
+        height=height,
+        width=width,
+        freeze=freeze,
+        fold_normalization=fold_normalization,
+        uint8_input=uint8_input,
+        opset=opset,
+    )
+    name = os.path.splitext(os.path.basename(checkpoint))[0]
+    onnx_path = os.path.join(onnx_dir, f"{name}_c{num_cameras}_b{batch_size}_{height}x{width}_{key[:16]}.onnx")
+    os.makedirs(onnx_dir, exist_ok=True)
+    # flock rather than an O_EXCL lock file: the kernel releases it when an exporting process dies
+    with open(onnx_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(onnx_path):
+                if policy is None:
+                    policy = load_policy(checkpoint, num_cameras, device, freeze, fold_normalization, uint8_input)
+                inputs = example_inputs(batch_size, num_cameras, height, width, device, uint8_input)
+                tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+                export_policy(policy, tmp_path, inputs, opset=opset)
+                os.replace(tmp_path, onnx_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return onnx_path
+
+
+def main(_deps=None, **deps):
+    ExportArgs._update(_deps, **deps)
+
+    policy = load_policy(
+        ExportArgs.checkpoint,
+        ExportArgs.num_cameras,
+        ExportArgs.device,
+        freeze=ExportArgs.freeze,
+        fold_normalization=ExportArgs.fold_normalization,
+        uint8_input=ExportArgs.uint8_input,
+    )
+
+    inputs = example_inputs(
+        ExportArgs.batch_size, ExportArgs.num_cameras, ExportArgs.height, ExportArgs.width, ExportArgs.device, ExportArgs.uint8_input
+    )
+    if ExportArgs.streaming:
+        from detr.streaming import export_streaming, validate_streaming
+
+        paths = export_streaming(
+            policy,
+            os.path.dirname(os.path.abspath(ExportArgs.onnx_path)),
+            batch_size=ExportArgs.batch_size,
+            height=ExportArgs.height,
+            width=ExportArgs.width,
+            device=ExportArgs.device,
+            uint8=ExportArgs.uint8_input,
+            opset=ExportArgs.opset,
+            dynamic_batch=ExportArgs.dynamic_batch,
+            constant_folding=ExportArgs.constant_folding,
+        )
+        print(f"Exported {paths[0]} and {paths[1]}")
+        if ExportArgs.validate:
+            validate_streaming(policy, *paths, *inputs, atol=ExportArgs.atol)
+        return
+
+    model = export_policy(
+        policy,
+        ExportArgs.onnx_path,
+        inputs,
+        opset=ExportArgs.opset,
+        dynamic_batch=ExportArgs.dynamic_batch,
+        dynamic_cameras=ExportArgs.dynamic_cameras,
+        constant_folding=ExportArgs.constant_folding,
+    )
+    print(f"Exported {ExportArgs.onnx_path}: {len(model.graph.node)} nodes, opset {ExportArgs.opset}")
+    if ExportArgs.optimize:
+        from maskclip_onnx.onnx_optimize import optimize_file
+
+        model = optimize_file(ExportArgs.onnx_path, ExportArgs.onnx_path, compare=False, layer_norm=ExportArgs.fuse_layer_norm)
+    for value in list(model.graph.input) + list(model.graph.output):
+        dims = [d.dim_param or d.dim_value for d in value.type.tensor_type.shape.dim]
+        print(f"  {value.name}: {dims}")
+
+    if ExportArgs.validate:
+        # validate off the traced shape where the axes are dynamic, to exercise them
+        batch_size = ExportArgs.batch_size + 1 if ExportArgs.dynamic_batch else ExportArgs.batch_size
+        num_cameras = ExportArgs.num_cameras
+        if ExportArgs.dynamic_cameras:
+            num_cameras = max(1, num_cameras - 1)
+            policy.model.num_cameras = num_cameras
+        validation_inputs = example_inputs(
+            batch_size, num_cameras, ExportArgs.height, ExportArgs.width, ExportArgs.device, ExportArgs.uint8_input
+        )
+        validate_onnx(policy, ExportArgs.onnx_path, validation_inputs, ExportArgs.atol)
+
+
+if __name__ == "__main__":
+    main()
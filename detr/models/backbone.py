@@ -5,6 +5,7 @@ Backbone modules.
 
 import IPython
 import torch
+import torch.nn.functional as F
 import torchvision
 from torch import nn
 from torchvision.models._utils import IntermediateLayerGetter
@@ -15,6 +16,9 @@ from .position_encoding import build_position_encoding
 
 e = IPython.embed
 
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
 
 class FrozenBatchNorm2d(torch.nn.Module):
     """
@@ -54,6 +58,51 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+class NormalizedStem(nn.Module):
+    """
+    conv1 and bn1 of a ResNet with the input normalization (x * input_scale - mean) / std folded into the
+    convolution, for inference on raw images.
+
+    The normalization offset is a constant inside the image, but conv1 zero-pads the normalized image, i.e.
+    pads the raw image with the mean, so the offset differs where the kernel overlaps the padding. It is
+    added as a per-position bias together with the batch norm shift, computed once per input size.
+    """
+
+    def __init__(self, conv: nn.Conv2d, bn: FrozenBatchNorm2d, mean, std, input_scale=1.0):
+        super().__init__()
+        weight = conv.weight.detach()
+        mean = torch.as_tensor(mean, dtype=weight.dtype, device=weight.device).reshape(1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=weight.dtype, device=weight.device).reshape(1, -1, 1, 1)
+        eps = 1e-5
+        scale = bn.weight * (bn.running_var + eps).rsqrt()
+        shift = bn.bias - bn.running_mean * scale
+        if conv.bias is not None:
+            shift = shift + conv.bias.detach() * scale
+        # the convolution applied to (x * input_scale - mean), with the batch norm scale
+        normalized_weight = weight / std * scale.reshape(-1, 1, 1, 1)
+        self.register_buffer("weight", normalized_weight * input_scale)
+        self.register_buffer("offset_weight", normalized_weight)
+        self.register_buffer("mean", mean)
+        self.register_buffer("shift", shift.reshape(1, -1, 1, 1))
+        self.stride, self.padding, self.dilation, self.groups = conv.stride, conv.padding, conv.dilation, conv.groups
+        self.bias_shape = None
+        self.bias_map = None
+
+    def _conv(self, x, weight):
+        return F.conv2d(x, weight, None, self.stride, self.padding, self.dilation, self.groups)
+
+    def forward(self, x):
+        shape = tuple(x.shape[-2:])
+        # recomputed after .to() and .half() too, which do not convert this plain attribute
+        if (self.bias_map is None or self.bias_shape != shape or self.bias_map.device != x.device
+                or self.bias_map.dtype != x.dtype):
+            with torch.no_grad():
+                bias_map = self.shift - self._conv(self.mean.expand(1, -1, *shape), self.offset_weight)
+                self.bias_map = bias_map.to(x.dtype)
+            self.bias_shape = shape
+        return self._conv(x, self.weight) + self.bias_map
+
+
 class BackboneBase(nn.Module):
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
         super().__init__()
@@ -78,6 +127,17 @@ class BackboneBase(nn.Module):
         #     out[name] = NestedTensor(x, mask)
         # return out
 
+    def fold_input_normalization(self, mean=IMAGENET_MEAN, std=IMAGENET_STD, input_scale=1.0):
+        """
+        Folds the input normalization into conv1 and bn1, see NormalizedStem. The backbone then takes
+        images that would be normalized by (x * input_scale - mean) / std, e.g. input_scale=1 / 255 for
+        uint8 ranged pixels. Inference only: the folded state dict no longer matches the training one.
+        """
+        if not isinstance(self.body.conv1, NormalizedStem):
+            self.body.conv1 = NormalizedStem(self.body.conv1, self.body.bn1, mean, std, input_scale)
+            self.body.bn1 = nn.Identity()
+        return self
+
 
 class Backbone(BackboneBase):
     """ResNet backbone with frozen BatchNorm."""
@@ -34,6 +34,9 @@ def get_sinusoid_encoding_table(n_position, d_hid):
 class DETRVAE(nn.Module):
     """This is the DETR module that performs object detection"""
 
+    # the cameras are folded into the batch, so the camera axis of image can be dynamic in ONNX
+    supports_dynamic_cameras = True
+
     def __init__(self, backbones, transformer, encoder, state_dim, num_queries, num_cameras):
         """Initializes the model.
         Parameters:
@@ -77,6 +80,8 @@ class DETRVAE(nn.Module):
         self.latent_out_proj = nn.Linear(self.latent_dim, hidden_dim)  # project latent sample to embedding
         self.additional_pos_embed = nn.Embedding(2, hidden_dim)  # learned position embedding for proprio and latent
 
+        self.frozen = False
+
     def forward(self, qpos, image, env_state, actions=None, is_pad=None):
         """
         qpos: batch, qpos_dim
@@ -85,6 +90,9 @@ class DETRVAE(nn.Module):
         actions: batch, seq, action_dim
         """
         is_training = actions is not None  # train or val
+        if self.frozen:
+            assert not is_training, "the CVAE encoder was dropped by freeze_for_inference"
+            return self.forward_frozen(qpos, image)
         bs, _ = qpos.shape
         ### Obtain latent z from action sequence
         if is_training:
@@ -116,27 +124,16 @@ class DETRVAE(nn.Module):
             latent_input = self.latent_out_proj(latent_sample)
 
         if self.backbones is not None:
-            # Image observation features and position embeddings
-            all_cam_features = []
-            all_cam_pos = []
-            for cam_id in range(self.num_cameras):
-                features, pos = self.backbones[0](image[:, cam_id])  # HARDCODED
-                features = features[0]  # take the last layer feature
-                pos = pos[0]
-                all_cam_features.append(self.input_proj(features))
-                all_cam_pos.append(pos)
-
-            # proprioception features
-            # make copy that is masked out scan dots
-            # fixme: weird to do this here, but will do for now
-            qpos_new = qpos.clone()
-            qpos_new[:, 53 : 53 + 132] = 0 # height map masked out
-
-            proprio_input = self.input_proj_robot_state(qpos_new)
-            # fold camera dimension into width dimension
-            src = torch.cat(all_cam_features, axis=3)
-            pos = torch.cat(all_cam_pos, axis=3)
-            hs = self.transformer(src, None, self.query_embed.weight, pos, latent_input, proprio_input, self.additional_pos_embed.weight)[0]
+            # Image observation features and position embeddings, all cameras in one batch
+            num_cameras = image.shape[1]
+            features, pos = self.encode_frame(image.flatten(0, 1))
+            _, c, h, w = features.shape
+
+            # fold camera dimension into width dimension, cameras in order like torch.cat(..., axis=3)
+            src = features.reshape(bs, num_cameras, c, h, w).permute(0, 2, 3, 1, 4).reshape(bs, c, h, -1)
+            # the sine position embedding only depends on the feature map shape, so it is the same for every camera
+            pos = pos.repeat(1, 1, 1, num_cameras)
+            hs = self.decode_features(qpos, src, pos, latent_input)
             # return hs, None, [None, None]
         else:
             raise NotImplementedError
@@ -148,6 +145,106 @@ class DETRVAE(nn.Module):
         is_pad_hat = self.is_pad_head(hs)
         return a_hat, is_pad_hat, [mu, logvar]
 
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        """
+        Specializes the model to inference from the prior, in place:
+            * the latent input is the bias of latent_out_proj, since the prior latent is zero
+            * the masking of the height map columns of qpos is folded into the weights of input_proj_robot_state
+            * query_embed and the position embeddings are broadcast over the batch instead of repeated,
+              and the image position embedding is computed once per feature map shape
+            * the CVAE encoder and its projections are dropped, and so are the decoder layers after the
+              output layer when the decoder is truncated
+        The actions match the unfrozen model; training is no longer possible.
+        """
+        if self.frozen:
+            return self
+        self.register_buffer("latent_input", self.latent_out_proj.bias.detach().clone().unsqueeze(0))
+
+        # zero weights instead of sliced ones keep the reduction, and so the result, bit-identical
+        self.input_proj_robot_state.weight[:, 53 : 53 + 132] = 0  # height map masked out
+
+        # position embedding of the last seen feature map shape, see _frozen_pos_embed
+        self.pos_embed_shape = None
+        self.pos_embed = None
+
+        del self.encoder, self.cls_embed, self.encoder_action_proj, self.encoder_joint_proj, self.latent_proj
+        del self.latent_out_proj, self.pos_table
+        self.encoder = None
+        decoder = self.transformer.decoder
+        if decoder.output_layer is not None:
+            decoder.output_layer %= decoder.num_layers
+            decoder.layers = decoder.layers[: decoder.output_layer + 1]
+            decoder.num_layers = len(decoder.layers)
+        self.frozen = True
+        return self
+
+    def forward_frozen(self, qpos, image):
+        # all cameras in one batch, without the position embedding of the backbone joiner
+        bs, num_cameras = image.shape[:2]
+        features = list(self.backbones[0][0](image.flatten(0, 1)).values())[0]
+        features = self.input_proj(features)
+        _, c, h, w = features.shape
+        src = features.reshape(bs, num_cameras, c, h, w).permute(0, 2, 3, 1, 4).reshape(bs, c, h, -1)
+        hs = self._decode_frozen(qpos, src, self._frozen_pos_embed(features, num_cameras))
+        a_hat = self.action_head(hs)
+        is_pad_hat = self.is_pad_head(hs)
+        return a_hat, is_pad_hat, [None, None]
+
+    def _frozen_pos_embed(self, features, num_cameras):
+        """
+        Position embedding of the latent / proprio tokens followed by the image features of num_cameras frames
+        of the shape of features, seq, 1, hidden_dim. Cached for the last shape.
+        """
+        shape = (num_cameras,) + tuple(features.shape[1:])
+        if self.pos_embed is None or self.pos_embed_shape != shape or self.pos_embed.device != features.device:
+            pos = self.backbones[0][1](features).to(features.dtype).repeat(1, 1, 1, num_cameras)
+            self.pos_embed = self._flat_pos_embed(pos)
+            self.pos_embed_shape = shape
+        return self.pos_embed
+
+    def _flat_pos_embed(self, pos):
+        return torch.cat([self.additional_pos_embed.weight.unsqueeze(1), pos.flatten(2).permute(2, 0, 1)], axis=0)
+
+    def _decode_frozen(self, qpos, src, pos_embed):
+        proprio_input = self.input_proj_robot_state(qpos)
+        latent_input = self.latent_input.expand(qpos.shape[0], -1)
+        src = torch.cat([torch.stack([latent_input, proprio_input], axis=0), src.flatten(2).permute(2, 0, 1)], axis=0)
+        return self.transformer.forward_flat(src, self.query_embed.weight.unsqueeze(1), pos_embed)[0]
+
+    def encode_frame(self, image):
+        """
+        Backbone and input projection of a single camera frame.
+        image: batch, channel, height, width (normalized)
+        Returns the projected features (batch, hidden_dim, h, w) and their position embedding (1, hidden_dim, h, w).
+        """
+        features, pos = self.backbones[0](image)  # HARDCODED
+        # take the last layer feature
+        return self.input_proj(features[0]), pos[0]
+
+    def decode_features(self, qpos, src, pos, latent_input=None):
+        """
+        Runs the transformer on the camera features folded into the width dimension.
+        qpos: batch, qpos_dim
+        src: batch, hidden_dim, h, num_cam * w
+        pos: 1, hidden_dim, h, num_cam * w
+        latent_input: batch, hidden_dim; the projection of a zero latent (the prior mean) when None
+        Returns the decoder output, batch, num_queries, hidden_dim.
+        """
+        if self.frozen:
+            return self._decode_frozen(qpos, src, self._flat_pos_embed(pos))
+        if latent_input is None:
+            latent_sample = torch.zeros([qpos.shape[0], self.latent_dim], dtype=torch.float32).to(qpos.device)
+            latent_input = self.latent_out_proj(latent_sample)
+        # proprioception features
+        # make copy that is masked out scan dots
+        # fixme: weird to do this here, but will do for now
+        qpos_new = qpos.clone()
+        qpos_new[:, 53 : 53 + 132] = 0 # height map masked out
+
+        proprio_input = self.input_proj_robot_state(qpos_new)
+        return self.transformer(src, None, self.query_embed.weight, pos, latent_input, proprio_input, self.additional_pos_embed.weight)[0]
+
 
 def mlp(input_dim, hidden_dim, output_dim, hidden_depth):
     if hidden_depth == 0:
@@ -31,6 +31,7 @@ class Transformer(nn.Module):
         activation="relu",
         normalize_before=False,
         return_intermediate_dec=False,
+        output_layer=None,
     ):
         super().__init__()
 
@@ -40,7 +41,9 @@ class Transformer(nn.Module):
 
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward, dropout, activation, normalize_before)
         decoder_norm = nn.LayerNorm(d_model)
-        self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm, return_intermediate=return_intermediate_dec)
+        self.decoder = TransformerDecoder(
+            decoder_layer, num_decoder_layers, decoder_norm, return_intermediate=return_intermediate_dec, output_layer=output_layer
+        )
 
         self._reset_parameters()
 
@@ -81,6 +84,18 @@ class Transformer(nn.Module):
         hs = hs.transpose(1, 2)
         return hs
 
+    def forward_flat(self, src, query_embed, pos_embed):
+        """
+        Inference on an already flattened sequence, see DETRVAE.freeze_for_inference.
+        src: seq, bs, dim
+        query_embed: num_queries, 1, dim and pos_embed: seq, 1, dim, broadcast over the batch instead of repeated
+        """
+        tgt = torch.zeros_like(query_embed).expand(-1, src.shape[1], -1)
+        memory = self.encoder(src, pos=pos_embed)
+        hs = self.decoder(tgt, memory, pos=pos_embed, query_pos=query_embed)
+        hs = hs.transpose(1, 2)
+        return hs
+
 
 class TransformerEncoder(nn.Module):
     def __init__(self, encoder_layer, num_layers, norm=None):
@@ -110,12 +125,14 @@ class TransformerEncoder(nn.Module):
 
 
 class TransformerDecoder(nn.Module):
-    def __init__(self, decoder_layer, num_layers, norm=None, return_intermediate=False):
+    def __init__(self, decoder_layer, num_layers, norm=None, return_intermediate=False, output_layer=None):
         super().__init__()
         self.layers = _get_clones(decoder_layer, num_layers)
         self.num_layers = num_layers
         self.norm = norm
         self.return_intermediate = return_intermediate
+        # when set, only the layers up to this one run, and its normed output is returned alone
+        self.output_layer = output_layer
 
         self.fake_norm = None
 
@@ -135,8 +152,12 @@ class TransformerDecoder(nn.Module):
         output = tgt
 
         intermediate = []
+        return_intermediate = self.return_intermediate and self.output_layer is None
 
-        for layer in self.layers:
+        layers = self.layers
+        if self.output_layer is not None:
+            layers = self.layers[: self.output_layer % self.num_layers + 1]
+        for layer in layers:
             output = layer(
                 output,
                 memory,
@@ -147,7 +168,7 @@ class TransformerDecoder(nn.Module):
                 pos=pos,
                 query_pos=query_pos,
             )
-            if self.return_intermediate:
+            if return_intermediate:
                 if SUPP_OLD_TRT:
                     intermediate.append(self.fake_norm(output))
                 else:
@@ -158,11 +179,11 @@ class TransformerDecoder(nn.Module):
                 output = self.fake_norm(output)
             else:
                 output = self.norm(output)
-            if self.return_intermediate:
+            if return_intermediate:
                 intermediate.pop()
                 intermediate.append(output)
 
-        if self.return_intermediate:
+        if return_intermediate:
             return torch.stack(intermediate)
 
         return output.unsqueeze(0)
@@ -423,7 +444,7 @@ def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
-def build_transformer(*, hidden_dim, dropout, nheads, dim_feedforward, enc_layers, dec_layers, pre_norm):
+def build_transformer(*, hidden_dim, dropout, nheads, dim_feedforward, enc_layers, dec_layers, pre_norm, output_layer=None):
     return Transformer(
         d_model=hidden_dim,
         dropout=dropout,
@@ -433,6 +454,7 @@ def build_transformer(*, hidden_dim, dropout, nheads, dim_feedforward, enc_layer
         num_decoder_layers=dec_layers,
         normalize_before=pre_norm,
         return_intermediate_dec=True,
+        output_layer=output_layer,
     )
 
 
@@ -5,7 +5,7 @@ import torchvision.transforms as transforms
 from params_proto import PrefixProto
 from torch.nn import functional as F
 
-from detr.models.backbone import build_backbone
+from detr.models.backbone import IMAGENET_MEAN, IMAGENET_STD, build_backbone
 from detr.models.detr_vae import build_encoder, DETRVAE
 from detr.models.transformer import build_transformer
 
@@ -50,6 +50,9 @@ class ACTArgs(PrefixProto):
     num_cameras: int = 1
     enc_layers: int = 4
     dec_layers: int = 6
+    # decoder layer whose output the action head reads, -1 for the last; the layers after it are skipped.
+    # None runs and stacks all of them, of which DETRVAE still only reads the first.
+    output_layer: int = 0
     dim_feedforward: int = 2048
     hidden_dim: int = 256
     dropout: float = 0.1
@@ -67,6 +70,10 @@ class ACTArgs(PrefixProto):
     kl_weight: float = None
     chunk_size: int = None
     temporal_agg: bool = False
+    # ActionChunkExecutor: control steps between policy queries, and the temporal ensembling weight
+    # exp(-temporal_agg_decay * i) of the i-th oldest chunk predicting the current step
+    query_interval: int = 1
+    temporal_agg_decay: float = 0.01
 
 
 e = IPython.embed
@@ -100,6 +107,7 @@ class ACTPolicy(nn.Module):
             pre_norm=ACTArgs.pre_norm,
             enc_layers=ACTArgs.enc_layers,
             dec_layers=ACTArgs.dec_layers,
+            output_layer=ACTArgs.output_layer,
         )
 
         encoder = build_encoder(
@@ -136,12 +144,13 @@ class ACTPolicy(nn.Module):
         self.optimizer = optimizer
         self.kl_weight = ACTArgs.kl_weight
         print(f"KL Weight {self.kl_weight}")
+        # None once folded into the backbone by fold_input_normalization
+        self.normalize = transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
 
     def __call__(self, image, qpos, actions=None, is_pad=None, **_):
         # note: at this point qpos contains privileged info to be used by the encoder. will be masked out before input to the decoder
         env_state = None
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        image = normalize(image)
+        image = self.preprocess(image)
         if actions is not None:  # training time
             assert False
             actions = actions[:, : self.model.num_queries]
@@ -175,6 +184,32 @@ class ACTPolicy(nn.Module):
             a_hat, _, (_, _) = self.model(qpos, image, env_state)  # no action, sample from prior
             return a_hat
 
+    def preprocess(self, image):
+        """Normalizes [0, 1] images, or only casts them to float when the normalization is folded into conv1."""
+        if self.normalize is None:
+            return image.float()
+        return self.normalize(image)
+
+    def fold_input_normalization(self, uint8=False):
+        """
+        Folds the ImageNet normalization into the first backbone convolution, which saves a pass over the
+        image at every step. With uint8=True the policy takes images in [0, 255], uint8 or float, instead of
+        [0, 1]. Inference only; load the checkpoint first.
+        """
+        self.model.backbones[0][0].fold_input_normalization(IMAGENET_MEAN, IMAGENET_STD, 1 / 255 if uint8 else 1.0)
+        self.normalize = None
+        return self
+
+    def freeze_for_inference(self):
+        """
+        Specializes the policy to inference, see DETRVAE.freeze_for_inference. Load the checkpoint first:
+        the frozen state dict no longer matches the training one.
+        """
+        self.model.freeze_for_inference()
+        # the optimizer holds on to the dropped encoder parameters
+        self.optimizer = None
+        return self
+
     def configure_optimizers(self):
         return self.optimizer
 
@@ -0,0 +1,221 @@
+"""
+Streaming inference over the ego camera history.
+
+ACTPolicy sees the last num_cameras ego frames, oldest first, and runs every one of them through the
+ResNet backbone at every control step, although all but the newest were already processed on earlier
+steps. The streaming policies here run the backbone and input projection on the newest frame only and
+keep the projected features of the history in a device-side ring buffer that feeds the transformer.
+
+The sine position embedding of a frame only depends on the feature map shape, so it is computed once
+instead of being cached per frame.
+
+The TensorRT deployment splits the policy into two engines: a frame encoder (frame -> features) and a
+history decoder (features of the whole history, obs_input -> actions), see export_streaming.
+"""
+
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+from detr.export import OUTPUT_NAMES, example_inputs, export_policy
+
+ENCODER_INPUT_NAMES = ["frame"]
+ENCODER_OUTPUT_NAMES = ["features"]
+DECODER_INPUT_NAMES = ["features", "obs_input"]
+
+
+class FeatureRing:
+    """
+    Ring buffer of the projected features of the last `length` frames, on the device of the features.
+    Until `length` frames were pushed, the first frame stands in for the missing older ones.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.buffer = None
+        self.head = 0  # slot the next frame is written to, i.e. the oldest frame
+        self.count = 0
+        self._orders = None
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+
+    def push(self, features):
+        """features: batch, channels, h, w"""
+        shape = (features.shape[0], self.length) + tuple(features.shape[1:])
+        if self.buffer is None or self.buffer.shape != shape or self.buffer.device != features.device:
+            self.buffer = torch.empty(shape, dtype=features.dtype, device=features.device)
+            # gather index of every head position, oldest frame first
+            self._orders = [torch.arange(head, head + self.length, device=features.device) % self.length
+                            for head in range(self.length)]
+            self.reset()
+        if self.count == 0:
+            self.buffer.copy_(features.unsqueeze(1).expand_as(self.buffer))
+        else:
+            self.buffer[:, self.head].copy_(features)
+        self.head = (self.head + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+
+    def folded(self):
+        """The history oldest first, folded into the width dimension: batch, channels, h, length * w."""
+        history = self.buffer.index_select(1, self._orders[self.head])
+        bs, n, c, h, w = history.shape
+        return history.permute(0, 2, 3, 1, 4).reshape(bs, c, h, n * w)
+
+
+class StreamingPolicy:
+    """
+    Runs an ACTPolicy one frame at a time. step(frame, qpos) after the history was filled returns the same
+    actions as policy(history, qpos), with one backbone pass instead of num_cameras.
+    """
+
+    def __init__(self, policy, num_cameras=None):
+        self.model = policy.model
+        self.num_cameras = num_cameras or self.model.num_cameras
+        self.preprocess = policy.preprocess
+        self.features = FeatureRing(self.num_cameras)
+        self.pos = None
+
+    def reset(self, image=None):
+        """
+        Clears the history, then pushes the frames of image (batch, num_cam, channel, height, width, oldest
+        first) when given.
+        """
+        self.features.reset()
+        if image is not None:
+            for cam_id in range(image.shape[1]):
+                self.push(image[:, cam_id])
+
+    @torch.no_grad()
+    def push(self, frame):
+        """Adds a frame (batch, channel, height, width) to the history without decoding actions."""
+        features, pos = self.model.encode_frame(self.preprocess(frame))
+        self.features.push(features)
+        if self.pos is None or self.pos.shape[-1] != pos.shape[-1] * self.num_cameras:
+            self.pos = pos.repeat(1, 1, 1, self.num_cameras)
+
+    @torch.no_grad()
+    def step(self, frame, qpos):
+        """
+        frame: batch, channel, height, width; the newest ego frame
+        qpos: batch, qpos_dim
+        Returns the action chunk, batch, num_queries, action_dim.
+        """
+        self.push(frame)
+        hs = self.model.decode_features(qpos, self.features.folded(), self.pos)
+        return self.model.action_head(hs)
+
+
+class FrameEncoder(nn.Module):
+    """First half of the two-engine split: frame (batch, channel, height, width) -> projected features."""
+
+    def __init__(self, policy):
+        super().__init__()
+        self.model = policy.model
+        self.preprocess = policy.preprocess
+
+    def forward(self, frame):
+        features, _ = self.model.encode_frame(self.preprocess(frame))
+        return features
+
+
+class HistoryDecoder(nn.Module):
+    """
+    Second half of the two-engine split: features of the history folded into the width dimension
+    (batch, hidden_dim, h, num_cameras * w) and obs_input -> actions.
+    """
+
+    def __init__(self, policy, num_cameras=None):
+        super().__init__()
+        self.model = policy.model
+        self.num_cameras = num_cameras or self.model.num_cameras
+
+    def forward(self, features, obs_input):
+        # position embedding of a single frame, which only depends on the shape and folds to a constant
+        frame_width = features.shape[3] // self.num_cameras
+        position_embedding = self.model.backbones[0][1]
+        pos = position_embedding(features[..., :frame_width]).to(features.dtype).repeat(1, 1, 1, self.num_cameras)
+        hs = self.model.decode_features(obs_input, features, pos)
+        return self.model.action_head(hs)
+
+
+def export_streaming(policy, output_dir, batch_size=1, num_cameras=None, height=180, width=320, device="cpu", uint8=False,
+                     **kwargs):
+    """
+    Exports the frame encoder and history decoder of a policy to output_dir/encoder.onnx and
+    output_dir/decoder.onnx. uint8 exports a uint8 frame input, see ACTPolicy.fold_input_normalization.
+    kwargs go to detr.export.export_policy. Returns both paths.
+    """
+    num_cameras = num_cameras or policy.model.num_cameras
+    encoder = FrameEncoder(policy).eval()
+    decoder = HistoryDecoder(policy, num_cameras).eval()
+    frame = example_inputs(batch_size, 1, height, width, device, uint8)[0][:, 0]
+    with torch.no_grad():
+        features = encoder(frame).repeat(1, 1, 1, num_cameras)
+    obs_input = torch.randn(batch_size, policy.model.input_proj_robot_state.in_features, device=device)
+
+    encoder_path = os.path.join(output_dir, "encoder.onnx")
+    decoder_path = os.path.join(output_dir, "decoder.onnx")
+    export_policy(encoder, encoder_path, (frame,), input_names=ENCODER_INPUT_NAMES,
+                  output_names=ENCODER_OUTPUT_NAMES, **kwargs)
+    export_policy(decoder, decoder_path, (features, obs_input), input_names=DECODER_INPUT_NAMES,
+                  output_names=OUTPUT_NAMES, **kwargs)
+    return encoder_path, decoder_path
+
+
+def validate_streaming(policy, encoder_path, decoder_path, image, qpos, atol=1e-4):
+    """
+    Runs both halves with ONNX Runtime on CPU, one frame at a time through a FeatureRing, and compares the
+    actions against policy(image, qpos). Returns the maximum absolute error.
+    """
+    import onnxruntime as ort
+
+    encoder = ort.InferenceSession(encoder_path, providers=["CPUExecutionProvider"])
+    decoder = ort.InferenceSession(decoder_path, providers=["CPUExecutionProvider"])
+    with torch.no_grad():
+        expected = policy(image, qpos).cpu().numpy()
+    ring = FeatureRing(image.shape[1])
+    for cam_id in range(image.shape[1]):
+        (features,) = encoder.run(ENCODER_OUTPUT_NAMES, {"frame": image[:, cam_id].cpu().numpy()})
+        ring.push(torch.from_numpy(features))
+    feeds = {"features": ring.folded().numpy(), "obs_input": qpos.cpu().numpy()}
+    (actions,) = decoder.run(OUTPUT_NAMES, feeds)
+    max_err = float(np.abs(actions - expected).max())
+    print(f"Streaming ONNX Runtime vs PyTorch max abs error: {max_err:.3e}")
+    if max_err > atol:
+        raise AssertionError(f"Streaming export differs from PyTorch by {max_err:.3e} > {atol:.1e}")
+    return max_err
+
+
+class TensorRTStreamingPolicy:
+    """
+    Two-engine deployment of StreamingPolicy. The encoder engine runs on the newest frame, its features
+    are copied into a FeatureRing on the GPU, and the decoder engine runs on the folded history.
+    kwargs go to maskclip_onnx.providers.prepare for both engines.
+    """
+
+    def __init__(self, encoder_path, decoder_path, num_cameras, device="CUDA:0", **kwargs):
+        from maskclip_onnx.providers import prepare
+
+        self.encoder = prepare(encoder_path, provider="tensorrt", device=device, **kwargs)
+        self.decoder = prepare(decoder_path, provider="tensorrt", device=device, **kwargs)
+        self.features = FeatureRing(num_cameras)
+
+    def reset(self, image=None):
+        self.features.reset()
+        if image is not None:
+            for cam_id in range(image.shape[1]):
+                self.push(image[:, cam_id])
+
+    def push(self, frame):
+        (features,) = self.encoder.run((frame,), "torch_cuda")
+        self.features.push(features)
+
+    def step(self, frame, qpos):
+        """frame: batch, channel, height, width (CUDA tensor); qpos: batch, qpos_dim. Returns the actions."""
+        self.push(frame)
+        (actions,) = self.decoder.run((self.features.folded(), qpos), "torch_cuda")
+        return actions
@@ -39,6 +39,7 @@ class EpisodicDataset(torch.utils.data.Dataset):
         self.num_cameras = num_cameras
         self.norm_stats = norm_stats
         self.is_sim = None
+        self.rng = np.random  # draws the timesteps; a seeded RandomState makes the samples reproducible
         self.__getitem__(0)  # initialize self.is_sim
 
     def __len__(self):
@@ -56,7 +57,7 @@ class EpisodicDataset(torch.utils.data.Dataset):
             if sample_full_episode:
                 start_ts = 0
             else:
-                start_ts = np.random.choice(episode_len)
+                start_ts = self.rng.choice(episode_len)
             # get observation at start_ts only
             qpos = root["/observations/prop"][start_ts]
 
@@ -254,6 +255,34 @@ def load_data_combined(dataset_dirs, num_cameras, batch_size_train, batch_size_v
     return train_dataloader, val_dataloader, norm_stats, train_dataset.is_sim
 
 
+def iterate_calibration_batches(dataset_dirs, num_cameras, norm_stats, batch_size, num_batches, seed=0, uint8=False):
+    """
+    Yields (image, qpos) float32 numpy batches drawn from random timesteps of the episodes in dataset_dirs,
+    normalized exactly like EpisodicDataset. Used to calibrate INT8 engines on representative inputs.
+    uint8 yields the images as the raw uint8 pixels instead, for policies exported with a uint8 input.
+    """
+    rng = np.random.RandomState(seed)
+    datasets = []
+    for dataset_dir in dataset_dirs:
+        all_files = sorted(glob.glob(os.path.join(dataset_dir, "episode_*.hdf5")))
+        all_episodes = [int(f.split("/")[-1].split("_")[1].split(".")[0]) for f in all_files]
+        if all_episodes:
+            datasets.append(EpisodicDataset(all_episodes, dataset_dir, num_cameras, norm_stats))
+    if not datasets:
+        raise FileNotFoundError(f"No episode_*.hdf5 files found in {dataset_dirs}")
+    combined = CombinedDataset(*datasets)
+    # seed picks the episodes and their timesteps, so one seed always yields the same batches
+    for dataset in datasets:
+        dataset.rng = rng
+
+    for _ in range(num_batches):
+        samples = [combined[i] for i in rng.randint(len(combined), size=batch_size)]
+        image = torch.stack([sample[0] for sample in samples]).float()
+        image = (image * 255.0).round().to(torch.uint8).numpy() if uint8 else image.numpy()
+        qpos = torch.stack([sample[1] for sample in samples]).float().numpy()
+        yield image, qpos
+
+
 ### env utils
 
 
@@ -0,0 +1,207 @@
+"""Dynamic request batching in front of a backend rep.
+
+Many simulated robots share one policy engine, each calling
+``rep.run((ego_view, obs_input), 'torch_cuda')`` with batch 1. DynamicBatcher
+queues those requests, coalesces them until either ``max_batch_size`` samples
+are waiting or the oldest request has waited ``max_latency_ms``, runs one
+engine call on the concatenated batch and scatters the outputs back to the
+callers. Per-batch-size counters make it possible to tune the window.
+"""
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+_STOP = object()
+
+
+class _Request(object):
+    __slots__ = ("inputs", "size", "future", "arrival")
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.size = inputs[0].shape[0]
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class BatchSizeStats(object):
+    """Counters for the batches of one size, with a window of recent latencies."""
+
+    def __init__(self, window=1024):
+        self.batches = 0
+        self.samples = 0
+        self.busy_time = 0.0
+        self.run_times = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def update(self, samples, run_time, latencies):
+        self.batches += 1
+        self.samples += samples
+        self.busy_time += run_time
+        self.run_times.append(run_time)
+        self.latencies.extend(latencies)
+
+    def summary(self):
+        latencies_ms = np.asarray(self.latencies) * 1e3
+        run_times_ms = np.asarray(self.run_times) * 1e3
+        return {
+            "batches": self.batches,
+            "samples": self.samples,
+            "throughput": self.samples / self.busy_time if self.busy_time > 0 else 0.0,
+            "run_ms_mean": float(run_times_ms.mean()) if len(run_times_ms) else 0.0,
+            "latency_ms_p50": float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else 0.0,
+            "latency_ms_p99": float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else 0.0,
+        }
+
+
+class DynamicBatcher(object):
+    def __init__(self, rep, max_batch_size=64, max_latency_ms=2.0, input_output_mode="torch_cuda", pad_to=None):
+        """Start a batching scheduler in front of a backend rep.
+        Args:
+            rep (BackendRep): TensorRTBackendRep or a provider rep; its engine must accept a variable batch
+                dimension (see optimization_profiles) unless pad_to is given
+            max_batch_size (int, optional): maximum number of samples per engine call. Defaults to 64.
+            max_latency_ms (float, optional): how long the oldest request may wait for the batch to fill. Defaults to 2.0.
+            input_output_mode (str, optional): 'numpy' or 'torch_cuda'. Defaults to 'torch_cuda'.
+            pad_to (list of int, optional): batch sizes the engine supports; batches are padded up to the smallest
+                one that fits by repeating the last sample. Defaults to None (no padding).
+        """
+        self.rep = rep
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.input_output_mode = input_output_mode
+        self.pad_to = sorted(pad_to) if pad_to is not None else None
+        if self.pad_to is not None and self.pad_to[-1] < max_batch_size:
+            raise ValueError("max_batch_size %i exceeds the largest padded batch size %i" % (max_batch_size, self.pad_to[-1]))
+        self._queue = queue.Queue()
+        self._carry = None
+        self._stats = defaultdict(BatchSizeStats)
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._serve, name="DynamicBatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs):
+        """Queue a request without waiting for it.
+        Args:
+            inputs (list or tuple): input arrays or tensors with a leading batch dimension, usually 1
+        Returns:
+            concurrent.futures.Future: resolves to the outputs of this request, as returned by rep.run
+        """
+        if isinstance(inputs, np.ndarray) or isinstance(inputs, torch.Tensor):
+            inputs = [inputs]
+        request = _Request(list(inputs))
+        if request.size > self.max_batch_size:
+            raise ValueError("Request batch %i exceeds max_batch_size %i" % (request.size, self.max_batch_size))
+        self._queue.put(request)
+        return request.future
+
+    def run(self, inputs, timeout=None):
+        """Queue a request and wait for its outputs."""
+        return self.submit(inputs).result(timeout)
+
+    __call__ = run
+
+    def close(self):
+        """Serve the requests already queued, then stop the scheduler thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        """Throughput and latency per batch size (before padding)."""
+        with self._stats_lock:
+            return {batch_size: stats.summary() for batch_size, stats in sorted(self._stats.items())}
+
+    def report(self):
+        lines = ["batch  batches  samples  samples/s  run ms  p50 ms  p99 ms"]
+        for batch_size, s in self.stats().items():
+            lines.append("%5i  %7i  %7i  %9.1f  %6.2f  %6.2f  %6.2f" % (
+                batch_size, s["batches"], s["samples"], s["throughput"],
+                s["run_ms_mean"], s["latency_ms_p50"], s["latency_ms_p99"]))
+        return "\n".join(lines)
+
+    def _next_request(self, timeout=None):
+        if self._carry is not None:
+            request, self._carry = self._carry, None
+            return request
+        return self._queue.get(timeout=timeout)
+
+    def _serve(self):
+        # engine calls happen on this thread, which needs the engine's CUDA context
+        with self.rep.thread_context():
+            while True:
+                request = self._next_request()
+                if request is _STOP:
+                    return
+                batch, size, stop = [request], request.size, False
+                deadline = request.arrival + self.max_latency
+                while size < self.max_batch_size:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = self._next_request(timeout)
+                    except queue.Empty:
+                        break
+                    if request is _STOP:
+                        stop = True
+                        break
+                    if size + request.size > self.max_batch_size:
+                        self._carry = request
+                        break
+                    batch.append(request)
+                    size += request.size
+                self._run_batch(batch, size)
+                if stop:
+                    self._queue.put(_STOP)
+
+    def _run_batch(self, batch, size):
+        try:
+            inputs = [_concat([request.inputs[i] for request in batch], self._padded_size(size))
+                      for i in range(len(batch[0].inputs))]
+            start = time.perf_counter()
+            outputs = self.rep.run(inputs, self.input_output_mode)
+            results = []
+            offset = 0
+            for request in batch:
+                # outputs alias engine-owned buffers that the next batch overwrites
+                results.append(type(outputs)(*[_copy(output[offset:offset + request.size]) for output in outputs]))
+                offset += request.size
+            end = time.perf_counter()
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+        with self._stats_lock:
+            self._stats[size].update(size, end - start, [end - request.arrival for request in batch])
+
+    def _padded_size(self, size):
+        if self.pad_to is None:
+            return size
+        return next(batch_size for batch_size in self.pad_to if batch_size >= size)
+
+
+def _concat(arrays, padded_size):
+    size = sum(array.shape[0] for array in arrays)
+    if padded_size > size:
+        last = arrays[-1][-1:]
+        arrays = arrays + [last] * (padded_size - size)
+    if isinstance(arrays[0], torch.Tensor):
+        return torch.cat(arrays) if len(arrays) > 1 else arrays[0]
+    return np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+
+def _copy(array):
+    return array.clone() if isinstance(array, torch.Tensor) else array.copy()
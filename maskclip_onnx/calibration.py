@@ -0,0 +1,112 @@
+"""INT8 post-training calibration for TensorRT engines.
+
+EntropyCalibrator feeds representative batches to the TensorRT builder and
+persists the resulting calibration cache, so later builds of the same model
+(another GPU, another workspace size, an evicted engine) skip the calibration
+pass. episode_calibrator streams ``(ego_view, obs)`` batches from the
+``episode_*.hdf5`` datasets with the same normalization as training:
+
+    calibrator = episode_calibrator(["data/parkour"], "ckpts/policy.calib", num_cameras=10)
+    rep = prepare("ckpts/policy.onnx", provider="tensorrt", int8_calibrator=calibrator)
+"""
+import os
+
+import numpy as np
+import pycuda.gpuarray
+import tensorrt as trt
+
+from maskclip_onnx.engine_cache import hash_file
+
+
+class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+    def __init__(self, batches, cache_file, batch_size):
+        """Create a calibrator.
+        Args:
+            batches (iterable): yields a list (in network input order) or a dict (by input name)
+                of numpy arrays with a leading batch dimension of batch_size and the dtype of the
+                network input, e.g. uint8 images; only consumed when there is no calibration cache yet
+            cache_file (str): path of the calibration cache, read if it exists and written after calibration
+            batch_size (int): batch size of the calibration batches
+        """
+        trt.IInt8EntropyCalibrator2.__init__(self)
+        self.cache_file = cache_file
+        self.batch_size = batch_size
+        self._batches = iter(batches)
+        self._device_buffers = {}
+        self.num_batches = 0
+
+    def cache_digest(self):
+        """sha256 of the calibration cache, or None before the first calibration."""
+        if not os.path.exists(self.cache_file):
+            return None
+        return hash_file(self.cache_file)
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_batch(self, names):
+        try:
+            batch = next(self._batches)
+        except StopIteration:
+            return None
+        if not isinstance(batch, dict):
+            batch = dict(zip(names, batch))
+        pointers = []
+        for name in names:
+            array = np.ascontiguousarray(batch[name])
+            if array.dtype == np.float64:
+                array = array.astype(np.float32)
+            buffer = self._device_buffers.get(name)
+            if buffer is None or buffer.shape != array.shape or buffer.dtype != array.dtype:
+                buffer = pycuda.gpuarray.empty(array.shape, array.dtype)
+                self._device_buffers[name] = buffer
+            buffer.set(array)
+            pointers.append(int(buffer.gpudata))
+        self.num_batches += 1
+        if self.num_batches % 10 == 0:
+            print("Calibrated on {} batches".format(self.num_batches))
+        return pointers
+
+    def read_calibration_cache(self):
+        if os.path.exists(self.cache_file):
+            print("Reading calibration cache {}".format(self.cache_file))
+            with open(self.cache_file, "rb") as f:
+                return f.read()
+        return None
+
+    def write_calibration_cache(self, cache):
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(bytes(cache))
+        os.replace(tmp_path, self.cache_file)
+        print("Calibration cache written to {}".format(self.cache_file))
+        self._device_buffers = {}
+
+
+def episode_calibrator(dataset_dirs, cache_file, num_cameras, batch_size=1, num_batches=512, norm_stats=None, seed=0,
+                       uint8=False):
+    """Calibrator over (ego_view, obs) batches sampled from episode_*.hdf5 datasets.
+    Args:
+        dataset_dirs (list of str): directories holding the episodes
+        cache_file (str): path of the calibration cache
+        num_cameras (int): number of stacked ego frames, as in ACTArgs.num_cameras
+        batch_size (int, optional): calibration batch size, the batch size the network was exported with.
+            Defaults to 1, like detr.export.
+        num_batches (int, optional): number of batches to calibrate on. Defaults to 512.
+        norm_stats (dict, optional): qpos normalization of the policy checkpoint.
+            Defaults to the statistics of dataset_dirs, as computed for training.
+        seed (int, optional): seed of the episode sampling. Defaults to 0.
+        uint8 (bool, optional): yield uint8 images, for networks exported with uint8_input. Defaults to False.
+    Returns:
+        EntropyCalibrator
+    """
+    from detr.utils import get_norm_stats_combined, iterate_calibration_batches
+
+    def batches():
+        stats = get_norm_stats_combined(dataset_dirs) if norm_stats is None else norm_stats
+        yield from iterate_calibration_batches(dataset_dirs, num_cameras, stats, batch_size, num_batches, seed,
+                                               uint8)
+
+    return EntropyCalibrator(batches(), cache_file, batch_size)
@@ -0,0 +1,241 @@
+"""Content-addressed store for serialized TensorRT engines.
+
+Engines are keyed on everything that changes the built engine: the ONNX bytes,
+the builder flags, the workspace size, the optimization profiles, the TensorRT
+version and the GPU. The store keeps a small JSON index next to the engines
+with the size, checksum and last use of every entry, evicts the least recently
+used engines once the cache grows past its size limit and validates the
+checksum before handing an engine out. The index is guarded by a file lock so
+several processes can share one cache directory. TensorRT timing caches live
+next to the engines, one per TensorRT version and GPU architecture, so that
+rebuilds reuse the tactic timings of earlier builds.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+INDEX_FILE = "index.json"
+MODELS_FILE = "models.json"
+LOCK_FILE = ".lock"
+ENGINE_SUFFIX = ".engine"
+TIMING_CACHE_SUFFIX = ".timing"
+DEFAULT_MAX_SIZE = 10 << 30  # 10 GiB
+
+
+def hash_bytes(data):
+    """sha256 hex digest of a bytes-like object."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 24):
+    """sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def engine_cache_key(onnx_digest, builder_flags, max_workspace_size, optimization_profiles, trt_version, device=None):
+    """Derive the cache key of an engine.
+    Args:
+        onnx_digest (str): sha256 of the serialized ONNX model
+        builder_flags (dict): builder flags that affect the engine, e.g. {'fp16': True, 'int8': False}
+        max_workspace_size (int): workspace memory pool limit in bytes
+        optimization_profiles (list or None): per-profile {input name: (min, opt, max)} shapes
+        trt_version (str): ``trt.__version__``
+        device (str, optional): GPU name and compute capability the engine is built for
+    Returns:
+        str: sha256 hex digest
+    """
+    payload = {
+        "onnx": onnx_digest,
+        "flags": builder_flags,
+        "workspace": max_workspace_size,
+        "profiles": optimization_profiles,
+        "tensorrt": trt_version,
+        "device": device,
+    }
+    return hash_bytes(json.dumps(payload, sort_keys=True, default=list).encode("utf-8"))
+
+
+class EngineCache(object):
+    def __init__(self, cache_dir, max_size=None):
+        """Open (or create) an engine cache.
+        Args:
+            cache_dir (str): directory holding the engines and the index
+            max_size (int, optional): total size in bytes before LRU eviction kicks in. Defaults to 10 GiB.
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = DEFAULT_MAX_SIZE if max_size is None else max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.cache_dir, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_json(self, name):
+        path = os.path.join(self.cache_dir, name)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except ValueError:
+            print("Engine cache file {} is corrupted, starting a new one".format(path))
+            return {}
+
+    def _write_json(self, name, data):
+        self._atomic_write(os.path.join(self.cache_dir, name), json.dumps(data, indent=2, sort_keys=True).encode("utf-8"))
+
+    def _read_index(self):
+        return self._read_json(INDEX_FILE)
+
+    def _write_index(self, index):
+        self._write_json(INDEX_FILE, index)
+
+    @staticmethod
+    def _atomic_write(path, data):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def model_digest(self, model_path):
+        """sha256 of a model file, memoized on its path, size and mtime so that cache hits only stat the file."""
+        path = os.path.abspath(model_path)
+        stat = os.stat(path)
+        with self._locked():
+            entry = self._read_json(MODELS_FILE).get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        digest = hash_file(path)
+        with self._locked():
+            models = self._read_json(MODELS_FILE)
+            models[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+            self._write_json(MODELS_FILE, models)
+        return digest
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ENGINE_SUFFIX)
+
+    def entries(self):
+        """Index entries, keyed by cache key."""
+        with self._locked():
+            return self._read_index()
+
+    def __contains__(self, key):
+        return key in self.entries()
+
+    def metadata(self, key):
+        """Metadata stored with an engine, or None if the key is not cached."""
+        entry = self.entries().get(key)
+        return None if entry is None else entry.get("metadata")
+
+    def get(self, key, verify=True):
+        """Load a cached engine.
+        Args:
+            key (str): cache key, see engine_cache_key
+            verify (bool, optional): check the sha256 of the engine file. Defaults to True.
+        Returns:
+            bytes or None: the serialized engine, None on a miss or a failed integrity check
+        """
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = self.path(key)
+            blob = None
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    blob = f.read()
+            if blob is None or len(blob) != entry["size"] or (verify and hash_bytes(blob) != entry["sha256"]):
+                print("Cached engine {} failed the integrity check, dropping it".format(key))
+                self._remove(index, key)
+                self._write_index(index)
+                return None
+            entry["last_used"] = time.time()
+            self._write_index(index)
+        return blob
+
+    def put(self, key, blob, metadata=None):
+        """Store a serialized engine and evict least recently used engines past the size limit.
+        Args:
+            key (str): cache key, see engine_cache_key
+            blob (bytes-like): serialized engine
+            metadata (dict, optional): JSON-serializable information stored with the engine
+        Returns:
+            str: path of the cached engine file
+        """
+        path = self.path(key)
+        with self._locked():
+            self._atomic_write(path, blob)
+            index = self._read_index()
+            now = time.time()
+            index[key] = {
+                "size": len(memoryview(blob).cast("B")),
+                "sha256": hash_bytes(blob),
+                "created": now,
+                "last_used": now,
+                "metadata": metadata,
+            }
+            self._evict(index, keep=key)
+            self._write_index(index)
+        return path
+
+    def timing_cache_path(self, tag):
+        return os.path.join(self.cache_dir, "timing-" + tag + TIMING_CACHE_SUFFIX)
+
+    def read_timing_cache(self, tag):
+        """Serialized timing cache for tag (e.g. TensorRT version and GPU architecture), or None."""
+        path = self.timing_cache_path(tag)
+        with self._locked():
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+
+    def update_timing_cache(self, tag, merge):
+        """Read-modify-write a timing cache under the lock, so concurrent builds do not drop each other's tactics.
+        Args:
+            tag (str): timing cache tag, see read_timing_cache
+            merge (callable): maps the stored cache (bytes or None) to the new serialized cache
+        """
+        path = self.timing_cache_path(tag)
+        with self._locked():
+            existing = None
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    existing = f.read()
+            self._atomic_write(path, merge(existing))
+
+    def remove(self, key):
+        with self._locked():
+            index = self._read_index()
+            self._remove(index, key)
+            self._write_index(index)
+
+    def _remove(self, index, key):
+        index.pop(key, None)
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def _evict(self, index, keep=None):
+        total_size = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total_size -= index[key]["size"]
+            print("Evicting engine {} from the cache ({:.1f} MB)".format(key, index[key]["size"] / 2**20))
+            self._remove(index, key)
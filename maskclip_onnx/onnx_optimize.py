@@ -0,0 +1,447 @@
+"""Graph rewriting for exported policy models, run between export and engine build.
+
+The exported ACT policy carries work TensorRT cannot always remove itself:
+    - constants: shape arithmetic on static shapes, tiled position and query
+      embeddings and Identity copies of shared weights are folded into initializers
+    - FrozenBatchNorm2d: the Mul/Add pair after every backbone convolution is
+      folded into the convolution weights and bias
+    - LayerNorm: the ReduceMean/Sub/Pow/ReduceMean/Add/Sqrt/Div(/Mul/Add) chains of
+      ``custom_layer_norm`` become one LayerNormalization node (opset >= 17; needs
+      TensorRT 8.6+, which is why it is opt-in while SUPP_OLD_TRT is set)
+    - masked inputs: a ScatterND writing zeros into fixed columns of a matrix
+      multiplication input (``qpos_new[:, 53:185] = 0``) is folded into zero weight rows
+
+    python -m maskclip_onnx.onnx_optimize policy.onnx policy_opt.onnx --fuse-layer-norm
+"""
+import argparse
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper
+from onnx.reference import ReferenceEvaluator
+
+NONDETERMINISTIC_OPS = {"RandomNormal", "RandomUniform", "RandomNormalLike", "RandomUniformLike", "Multinomial", "Bernoulli"}
+MAX_FOLDED_ELEMENTS = 1 << 22
+
+
+def _opset(model):
+    return next(o.version for o in model.opset_import if o.domain in ("", "ai.onnx"))
+
+
+def _attribute(node, name, default=None):
+    for attribute in node.attribute:
+        if attribute.name == name:
+            return helper.get_attribute_value(attribute)
+    return default
+
+
+def _static_shapes(model):
+    """Shapes of the tensors whose dimensions are all known after shape inference."""
+    inferred = onnx.shape_inference.infer_shapes(model)
+    shapes = {}
+    for value in list(inferred.graph.input) + list(inferred.graph.value_info) + list(inferred.graph.output):
+        if not value.type.tensor_type.HasField("shape"):
+            continue
+        dims = value.type.tensor_type.shape.dim
+        if all(dim.HasField("dim_value") for dim in dims):
+            shapes[value.name] = tuple(dim.dim_value for dim in dims)
+    return shapes
+
+
+def _consumers(graph, nodes):
+    consumers = {}
+    for node in nodes:
+        for name in node.input:
+            consumers.setdefault(name, []).append(node)
+    for output in graph.output:
+        consumers.setdefault(output.name, []).append(None)
+    return consumers
+
+
+def _initializers(graph):
+    return {initializer.name: initializer for initializer in graph.initializer}
+
+
+def _rebuild(model, nodes, constants):
+    """Replace the nodes of the graph and keep the initializers (from constants) that are still referenced."""
+    graph = model.graph
+    used = set(name for node in nodes for name in node.input) | set(output.name for output in graph.output)
+    initializers = [numpy_helper.from_array(np.asarray(value), name) for name, value in constants.items() if name in used]
+    del graph.node[:]
+    graph.node.extend(nodes)
+    del graph.initializer[:]
+    graph.initializer.extend(initializers)
+    graph_inputs = [value for value in graph.input if value.name not in constants]
+    del graph.input[:]
+    graph.input.extend(graph_inputs)
+    del graph.value_info[:]
+    return model
+
+
+def fold_constants(model, max_elements=MAX_FOLDED_ELEMENTS):
+    """Evaluate every node whose inputs are constants, and Shape nodes of statically shaped tensors.
+    Returns:
+        int: number of folded nodes
+    """
+    graph = model.graph
+    opset = _opset(model)
+    shapes = _static_shapes(model)
+    constants = OrderedDict((name, numpy_helper.to_array(initializer)) for name, initializer in _initializers(graph).items())
+    graph_outputs = set(output.name for output in graph.output)
+    aliases = {}
+    nodes = []
+    folded = 0
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name in aliases:
+                node.input[i] = aliases[name]
+        if node.op_type in NONDETERMINISTIC_OPS or node.domain not in ("", "ai.onnx"):
+            nodes.append(node)
+            continue
+        if node.op_type == "Identity" and node.input[0] in constants and node.output[0] not in graph_outputs:
+            # consumers read the constant directly instead of a copy of it
+            aliases[node.output[0]] = node.input[0]
+            folded += 1
+            continue
+        if node.op_type == "Shape" and node.input[0] in shapes:
+            shape = np.array(shapes[node.input[0]], dtype=np.int64)
+            start, end = _attribute(node, "start", 0), _attribute(node, "end", None)
+            values = [shape[start:end]]
+        elif all(name == "" or name in constants for name in node.input):
+            feeds = {name: constants[name] for name in node.input if name != ""}
+            values = ReferenceEvaluator(node, opsets={"": opset}).run(None, feeds)
+        else:
+            nodes.append(node)
+            continue
+        if any(np.asarray(value).size > max_elements for value in values):
+            nodes.append(node)
+            continue
+        for name, value in zip(node.output, values):
+            constants[name] = np.asarray(value)
+        folded += 1
+    _rebuild(model, nodes, constants)
+    return folded
+
+
+def _per_channel(value, channels):
+    """A constant broadcast along the channel axis of an NCHW tensor, as a (C,) vector; None otherwise."""
+    value = np.asarray(value)
+    if value.size == 1:
+        return np.full(channels, value.reshape(()), dtype=value.dtype)
+    squeezed = value.reshape(-1)
+    if squeezed.size != channels:
+        return None
+    if value.ndim == 4 and value.shape[:2] == (1, channels) and value.shape[2:] == (1, 1):
+        return squeezed
+    if value.ndim == 3 and value.shape == (channels, 1, 1):
+        return squeezed
+    return None
+
+
+def _other_input(node, name):
+    return node.input[1] if node.input[0] == name else node.input[0]
+
+
+def fold_batchnorm_into_conv(model):
+    """Fold per-channel Mul and Add constants that follow a convolution into its weights and bias.
+    Returns:
+        int: number of folded Mul/Add nodes
+    """
+    graph = model.graph
+    constants = OrderedDict((name, numpy_helper.to_array(initializer)) for name, initializer in _initializers(graph).items())
+    # one list of the node wrappers, so that their ids stay valid for the whole pass
+    nodes = list(graph.node)
+    consumers = _consumers(graph, nodes)
+    removed = set()
+    folded = 0
+    for node in nodes:
+        # the optional bias may be omitted or given as the empty name
+        bias_name = node.input[2] if len(node.input) > 2 else ""
+        if node.op_type != "Conv" or node.input[1] not in constants or (bias_name and bias_name not in constants):
+            continue
+        weight = constants[node.input[1]]
+        channels = weight.shape[0]
+        bias = constants[bias_name] if bias_name else np.zeros(channels, weight.dtype)
+        output = node.output[0]
+        changed = False
+        while True:
+            users = consumers.get(output, [])
+            if len(users) != 1 or users[0] is None or users[0].op_type not in ("Mul", "Add"):
+                break
+            user = users[0]
+            constant = _other_input(user, output)
+            vector = _per_channel(constants[constant], channels) if constant in constants else None
+            if vector is None:
+                break
+            if user.op_type == "Mul":
+                weight = weight * vector.reshape((-1,) + (1,) * (weight.ndim - 1))
+                bias = bias * vector
+            else:
+                bias = bias + vector
+            removed.add(id(user))
+            output = user.output[0]
+            changed = True
+            folded += 1
+        if changed:
+            weight_name, bias_name = node.output[0] + "_folded_weight", node.output[0] + "_folded_bias"
+            constants[weight_name] = weight.astype(constants[node.input[1]].dtype)
+            constants[bias_name] = bias.astype(constants[node.input[1]].dtype)
+            data = node.input[0]
+            del node.input[:]
+            node.input.extend([data, weight_name, bias_name])
+            node.output[0] = output
+    _rebuild(model, [node for node in nodes if id(node) not in removed], constants)
+    return folded
+
+
+def _reduces_last_axis(node, constants, rank):
+    if node.op_type != "ReduceMean" or _attribute(node, "keepdims", 1) != 1:
+        return False
+    axes = _attribute(node, "axes")
+    if axes is None and len(node.input) > 1:
+        axes = constants.get(node.input[1])
+    if axes is None:
+        return False
+    axes = [int(axis) for axis in np.asarray(axes).reshape(-1)]
+    return len(axes) == 1 and axes[0] in (-1, rank - 1)
+
+
+def fuse_layer_norm(model):
+    """Replace decomposed layer normalizations over the last axis with LayerNormalization nodes.
+    Returns:
+        int: number of fused layer normalizations
+    """
+    if _opset(model) < 17:
+        raise ValueError("LayerNormalization needs opset 17 or newer, the model has opset %i" % _opset(model))
+    graph = model.graph
+    shapes = _static_shapes(model)
+    inferred = onnx.shape_inference.infer_shapes(model)
+    ranks = {value.name: len(value.type.tensor_type.shape.dim)
+             for value in list(inferred.graph.input) + list(inferred.graph.value_info) + list(inferred.graph.output)
+             if value.type.tensor_type.HasField("shape")}
+    constants = OrderedDict((name, numpy_helper.to_array(initializer)) for name, initializer in _initializers(graph).items())
+    nodes = list(graph.node)
+    consumers = _consumers(graph, nodes)
+
+    def only_user(name, op_type):
+        users = consumers.get(name, [])
+        if len(users) == 1 and users[0] is not None and users[0].op_type == op_type:
+            return users[0]
+        return None
+
+    replacements = {}
+    removed = set()
+    for mean in nodes:
+        x = mean.input[0] if mean.input else None
+        if x is None or x not in ranks or not _reduces_last_axis(mean, constants, ranks[x]):
+            continue
+        sub = only_user(mean.output[0], "Sub")
+        if sub is None or list(sub.input) != [x, mean.output[0]]:
+            continue
+        diff_users = consumers.get(sub.output[0], [])
+        pow_ = next((user for user in diff_users if user is not None and user.op_type == "Pow"), None)
+        div = next((user for user in diff_users if user is not None and user.op_type == "Div"), None)
+        if len(diff_users) != 2 or pow_ is None or div is None or div.input[0] != sub.output[0]:
+            continue
+        if pow_.input[1] not in constants or not np.all(constants[pow_.input[1]] == 2):
+            continue
+        variance = only_user(pow_.output[0], "ReduceMean")
+        if variance is None or not _reduces_last_axis(variance, constants, ranks[x]):
+            continue
+        add_eps = only_user(variance.output[0], "Add")
+        if add_eps is None:
+            continue
+        eps = constants.get(_other_input(add_eps, variance.output[0]))
+        if eps is None or np.asarray(eps).size != 1:
+            continue
+        sqrt = only_user(add_eps.output[0], "Sqrt")
+        if sqrt is None or only_user(sqrt.output[0], "Div") is not div or div.input[1] != sqrt.output[0]:
+            continue
+        chain = [mean, sub, pow_, variance, add_eps, sqrt, div]
+        output = div.output[0]
+        hidden = shapes[x][-1] if x in shapes else None
+        scale = bias = None
+        mul = only_user(output, "Mul")
+        if mul is not None and constants.get(_other_input(mul, output)) is not None \
+                and constants[_other_input(mul, output)].ndim == 1:
+            scale = _other_input(mul, output)
+            chain.append(mul)
+            output = mul.output[0]
+            add_bias = only_user(output, "Add")
+            if add_bias is not None and constants.get(_other_input(add_bias, output)) is not None \
+                    and constants[_other_input(add_bias, output)].ndim == 1:
+                bias = _other_input(add_bias, output)
+                chain.append(add_bias)
+                output = add_bias.output[0]
+        if scale is None:
+            if hidden is None:
+                continue
+            scale = mean.output[0] + "_scale"
+            constants[scale] = np.ones(hidden, dtype=np.float32)
+        inputs = [x, scale] + ([bias] if bias is not None else [])
+        fused = helper.make_node("LayerNormalization", inputs, [output], name=mean.name + "_fused",
+                                 axis=-1, epsilon=float(np.asarray(eps).reshape(())))
+        # the fused node takes the place of the last node of the chain, after all of its inputs
+        replacements[id(chain[-1])] = fused
+        removed.update(id(node) for node in chain[:-1])
+    _rebuild(model, [replacements.get(id(node), node) for node in nodes if id(node) not in removed], constants)
+    return len(replacements)
+
+
+def fold_masked_inputs(model):
+    """Fold a ScatterND that zeroes the same columns of every row of a matrix multiplication input into
+    zero rows of the weight, so the masked copy of the input is never materialized.
+    Returns:
+        int: number of folded ScatterND nodes
+    """
+    graph = model.graph
+    shapes = _static_shapes(model)
+    constants = OrderedDict((name, numpy_helper.to_array(initializer)) for name, initializer in _initializers(graph).items())
+    nodes = list(graph.node)
+    consumers = _consumers(graph, nodes)
+    removed = set()
+    for scatter in nodes:
+        if scatter.op_type != "ScatterND" or _attribute(scatter, "reduction", b"none") not in (b"none", "none"):
+            continue
+        data, indices, updates = scatter.input
+        if indices not in constants or updates not in constants or data not in shapes or len(shapes[data]) != 2:
+            continue
+        if np.any(constants[updates] != 0):
+            continue
+        rows, columns = shapes[data]
+        index = constants[indices].reshape(-1, constants[indices].shape[-1])
+        if index.shape[1] != 2:
+            continue
+        zeroed = [set(index[index[:, 0] == row, 1].tolist()) for row in range(rows)]
+        if not zeroed or any(row != zeroed[0] for row in zeroed):
+            continue
+        users = consumers.get(scatter.output[0], [])
+        if len(users) != 1 or users[0] is None or users[0].op_type not in ("Gemm", "MatMul"):
+            continue
+        user = users[0]
+        if user.input[0] != scatter.output[0] or user.input[1] not in constants:
+            continue
+        if user.op_type == "Gemm" and _attribute(user, "transA", 0):
+            continue
+        weight = constants[user.input[1]].copy()
+        cols = sorted(zeroed[0])
+        if user.op_type == "Gemm" and _attribute(user, "transB", 0):
+            weight[:, cols] = 0
+        else:
+            weight[cols, :] = 0
+        weight_name = scatter.output[0] + "_masked_weight"
+        constants[weight_name] = weight
+        user.input[0] = data
+        user.input[1] = weight_name
+        removed.add(id(scatter))
+    _rebuild(model, [node for node in nodes if id(node) not in removed], constants)
+    return len(removed)
+
+
+def op_counts(model):
+    return Counter(node.op_type for node in model.graph.node)
+
+
+def optimize_model(model, constant_folding=True, batchnorm=True, layer_norm=False, masked_inputs=True):
+    """Run the rewriting passes on a copy of the model.
+    Args:
+        model (onnx.ModelProto): exported model
+        constant_folding (bool, optional): fold constant and static-shape subgraphs. Defaults to True.
+        batchnorm (bool, optional): fold per-channel Mul/Add after convolutions. Defaults to True.
+        layer_norm (bool, optional): fuse LayerNormalization nodes (TensorRT 8.6+). Defaults to False.
+        masked_inputs (bool, optional): fold zeroing ScatterNDs into matrix multiplication weights. Defaults to True.
+    Returns:
+        (onnx.ModelProto, dict): the optimized model and the number of rewrites per pass
+    """
+    optimized = onnx.ModelProto()
+    optimized.CopyFrom(model)
+    rewrites = OrderedDict()
+    if constant_folding:
+        rewrites["constant_folding"] = fold_constants(optimized)
+    if batchnorm:
+        rewrites["batchnorm"] = fold_batchnorm_into_conv(optimized)
+    if masked_inputs:
+        rewrites["masked_inputs"] = fold_masked_inputs(optimized)
+    if layer_norm:
+        rewrites["layer_norm"] = fuse_layer_norm(optimized)
+    if constant_folding:
+        # the passes above leave constant subgraphs behind, e.g. the Mul of a folded Mul/Add pair
+        rewrites["constant_folding"] += fold_constants(optimized)
+    optimized = onnx.shape_inference.infer_shapes(optimized)
+    onnx.checker.check_model(optimized)
+    return optimized, rewrites
+
+
+def _random_feeds(model, batch_size=1):
+    """Inputs of the graph in the dtype it declares: floats in [0, 1), uint8 pixels, other integers zero."""
+    initializers = {init.name for init in model.graph.initializer}
+    feeds = {}
+    for value in model.graph.input:
+        if value.name in initializers:
+            continue
+        tensor_type = value.type.tensor_type
+        shape = [dim.dim_value if dim.HasField("dim_value") else batch_size for dim in tensor_type.shape.dim]
+        dtype = helper.tensor_dtype_to_np_dtype(tensor_type.elem_type)
+        if np.issubdtype(dtype, np.floating):
+            feeds[value.name] = np.random.rand(*shape).astype(dtype)
+        elif dtype == np.uint8:
+            feeds[value.name] = np.random.randint(0, 256, size=shape, dtype=np.uint8)
+        else:
+            # integer inputs are typically indices, which zeros keep in range
+            feeds[value.name] = np.zeros(shape, dtype=dtype)
+    return feeds
+
+
+def compare_models(original_path, optimized_path, iterations=20):
+    """Max abs difference and mean latency of the two models with ONNX Runtime on CPU."""
+    import onnxruntime as ort
+
+    sessions = [ort.InferenceSession(path, providers=["CPUExecutionProvider"]) for path in (original_path, optimized_path)]
+    feeds = _random_feeds(onnx.load(original_path, load_external_data=False))
+    outputs, latencies = [], []
+    for session in sessions:
+        outputs.append(session.run(None, feeds))
+        start = time.perf_counter()
+        for _ in range(iterations):
+            session.run(None, feeds)
+        latencies.append((time.perf_counter() - start) / iterations * 1e3)
+    max_err = max(float(np.abs(a - b).max()) for a, b in zip(*outputs))
+    return {"max_abs_err": max_err, "original_ms": latencies[0], "optimized_ms": latencies[1]}
+
+
+def report(before, after, rewrites, comparison=None):
+    lines = ["rewrites: " + ", ".join("%s %i" % item for item in rewrites.items()),
+             "op                    before  after"]
+    for op in sorted(set(before) | set(after), key=lambda op: -before.get(op, 0)):
+        if before.get(op, 0) != after.get(op, 0):
+            lines.append("%-20s %7i %6i" % (op, before.get(op, 0), after.get(op, 0)))
+    lines.append("%-20s %7i %6i" % ("total", sum(before.values()), sum(after.values())))
+    if comparison is not None:
+        lines.append("onnxruntime CPU: %.2f ms -> %.2f ms, max abs err %.2e" % (
+            comparison["original_ms"], comparison["optimized_ms"], comparison["max_abs_err"]))
+    return "\n".join(lines)
+
+
+def optimize_file(input_path, output_path, compare=True, **passes):
+    model = onnx.load(input_path)
+    optimized, rewrites = optimize_model(model, **passes)
+    onnx.save(optimized, output_path)
+    comparison = compare_models(input_path, output_path) if compare else None
+    print(report(op_counts(model), op_counts(optimized), rewrites, comparison))
+    return optimized
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize an exported ONNX policy graph.")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--fuse-layer-norm", action="store_true", help="needs TensorRT 8.6+")
+    parser.add_argument("--no-compare", action="store_true", help="skip the ONNX Runtime comparison")
+    args = parser.parse_args()
+    optimize_file(args.input, args.output, compare=not args.no_compare, layer_norm=args.fuse_layer_norm)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,27 +3,78 @@ Mostly scraped from https://github.com/onnx/onnx-tensorrt
 Enhanced with the following features:
     - Support FP32/FP16/INT8 precision
     - Support serialization/deserialization of TensorRT engines to speed up
+    - Support dynamic shapes through optimization profiles declared at prepare() time
 """
 from __future__ import print_function
 import os
+import atexit
+import functools
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 import tensorrt as trt
 from onnx.backend.base import Backend, BackendRep, Device, DeviceType, namedtupledict
 import onnx
 import torch
 import ctypes
 from onnx import helper as onnx_helper
+from onnx import numpy_helper
 import numpy as np
 import six
 from six import string_types
 import pycuda.driver
 import pycuda.gpuarray
-import pycuda.autoinit
 import numba
 from numba import cuda
+from maskclip_onnx.engine_cache import ENGINE_SUFFIX, EngineCache, engine_cache_key, hash_bytes
+from maskclip_onnx.profiling import StageProfiler
 # HACK Should look for a better way/place to do this
 from ctypes import cdll, c_char_p
 libcudart = cdll.LoadLibrary('libcudart.so')
 libcudart.cudaGetErrorString.restype = c_char_p
+# Run pycuda in the device's primary context, the one PyTorch uses, instead of the private context
+# pycuda.autoinit creates. Kernels cannot touch memory owned by another context, so this is what
+# allows the engine to read and write torch tensors in place (see IOBinding).
+# The CUDA_DEVICE context is current on the importing thread; reps on other devices push their own.
+pycuda.driver.init()
+CUDA_DEVICE_ID = int(os.environ.get('CUDA_DEVICE', 0))
+CUDA_DEVICE = pycuda.driver.Device(CUDA_DEVICE_ID)
+# Before TensorRT 10 an optimization profile can only be selected by one execution context at a time,
+# so a dynamic-shape engine supports a single context there
+SHARED_PROFILES = int(trt.__version__.split('.')[0]) >= 10
+CUDA_CONTEXT = CUDA_DEVICE.retain_primary_context()
+CUDA_CONTEXT.push()
+atexit.register(CUDA_CONTEXT.pop)
+_PRIMARY_CONTEXTS = {CUDA_DEVICE_ID: CUDA_CONTEXT}
+_PRIMARY_CONTEXTS_LOCK = threading.Lock()
+def primary_context(device_id=None):
+    """The retained primary context of a device, the one PyTorch uses on it. Defaults to CUDA_DEVICE."""
+    device_id = CUDA_DEVICE_ID if device_id is None else device_id
+    with _PRIMARY_CONTEXTS_LOCK:
+        context = _PRIMARY_CONTEXTS.get(device_id)
+        if context is None:
+            context = _PRIMARY_CONTEXTS[device_id] = pycuda.driver.Device(device_id).retain_primary_context()
+    return context
+@contextmanager
+def cuda_context(device_id=None):
+    """Make the CUDA context of the engines on a device (CUDA_DEVICE by default) current on the calling thread."""
+    primary_context(device_id).push()
+    try:
+        yield
+    finally:
+        pycuda.driver.Context.pop()
+def _in_device_context(method):
+    """Run a rep method with the context of the rep's device current, when it is not the one current by default."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.device_id == CUDA_DEVICE_ID:
+            return method(self, *args, **kwargs)
+        with cuda_context(self.device_id):
+            return method(self, *args, **kwargs)
+    return wrapper
 TORCH_NP_DTYPE_MAP = {
     # signed integers
     torch.int8: np.int8,
@@ -61,8 +112,42 @@ def count_trailing_ones(vals):
         count += 1
     return count
 TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+IO_METADATA_SUFFIX = '.json'
+def _io_metadata_from_model(model):
+    """I/O metadata needed by TensorRTBackendRep.run, read from the ONNX graph."""
+    outputs = OrderedDict()
+    for output in model.graph.output:
+        dims = output.type.tensor_type.shape.dim
+        outputs[output.name] = {'shape': [dim.dim_value for dim in dims],
+                                'elem_type': output.type.tensor_type.elem_type}
+    inputs = OrderedDict()
+    for graph_input in model.graph.input:
+        dims = graph_input.type.tensor_type.shape.dim
+        inputs[graph_input.name] = {'shape': [dim.dim_value if dim.HasField('dim_value') else -1 for dim in dims],
+                                    'elem_type': graph_input.type.tensor_type.elem_type}
+    return {'inputs': inputs, 'outputs': outputs}
+def _normalize_profiles(optimization_profiles):
+    """Optimization profiles as a list of {input name: [min, opt, max]} with shapes as int lists."""
+    if optimization_profiles is None:
+        return None
+    if isinstance(optimization_profiles, dict):
+        optimization_profiles = [optimization_profiles]
+    return [OrderedDict((name, [[int(dim) for dim in shape] for shape in shapes])
+                        for name, shapes in sorted(profile.items()))
+            for profile in optimization_profiles]
+def _read_io_metadata(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+def _write_io_metadata(path, io_metadata):
+    with open(path, 'w') as f:
+        json.dump(io_metadata, f, indent=2)
+DEFAULT_STAGING_DEPTH = 2
 class Binding(object):
-    def __init__(self, engine, idx_or_name):
+    def __init__(self, engine, idx_or_name, max_shapes=None, staging_depth=DEFAULT_STAGING_DEPTH,
+                 device_id=CUDA_DEVICE_ID):
+        self.torch_device = torch.device('cuda', device_id)
         if isinstance(idx_or_name, string_types):
             self.name = idx_or_name
         else:
@@ -80,11 +165,26 @@ class Binding(object):
             dtype_map[trt.DataType.INT32] = np.int32
         if hasattr(trt.DataType, 'INT64'):
             dtype_map[trt.DataType.INT64] = np.int64
+        if hasattr(trt.DataType, 'UINT8'):
+            # uint8 image inputs, see ACTPolicy.fold_input_normalization
+            dtype_map[trt.DataType.UINT8] = np.uint8
+        if dtype not in dtype_map:
+            raise TypeError("Unsupported dtype {} of binding {}".format(dtype, self.name))
         self.dtype = dtype_map[dtype]
         shape = engine.get_tensor_shape(self.name)
-        self.shape = tuple(shape)
+        self.engine_shape = tuple(shape)
+        self.is_dynamic = -1 in self.engine_shape
+        # buffers of dynamic tensors are sized for the largest shape over all optimization profiles
+        if self.is_dynamic and max_shapes is not None:
+            self.shape = tuple(max_shapes[self.name])
+        else:
+            self.shape = self.engine_shape
         self._host_buf   = None
         self._device_buf = None
+        self._torch_buf  = None
+        self.staging_depth = staging_depth
+        self._staging = None # ring of (page-locked buffer, event of the copy out of it)
+        self._next_staging = 0
     @property
     def host_buffer(self):
         if self._host_buf is None:
@@ -97,15 +197,45 @@ class Binding(object):
             self._device_buf = pycuda.gpuarray.empty(self.shape, self.dtype)
         return self._device_buf
     
-    def get_async(self, stream, input_output_mode):
+    @property
+    def torch_buffer(self):
+        """The device buffer as a torch tensor, created once and reused by every call."""
+        if self._torch_buf is None:
+            self._torch_buf = torch.as_tensor(cuda.as_cuda_array(self.device_buffer), device=self.torch_device)
+        return self._torch_buf
+    def stage_async(self, array, stream):
+        """Copy a host array to the device buffer through the next page-locked buffer of the staging ring.
+        The array is written once into pinned memory, so the copy to the device is truly asynchronous and
+        the caller may reuse the array as soon as this returns.
+        """
+        if self._staging is None:
+            self._staging = [(pycuda.driver.pagelocked_empty(self.shape, self.dtype), pycuda.driver.Event())
+                             for _ in range(self.staging_depth)]
+        staging, copied = self._staging[self._next_staging]
+        self._next_staging = (self._next_staging + 1) % len(self._staging)
+        # the previous copy out of this buffer must have finished before it is overwritten
+        copied.synchronize()
+        if staging.shape != array.shape:
+            staging = staging.reshape(-1)[:array.size].reshape(array.shape)
+        np.copyto(staging, array)
+        pycuda.driver.memcpy_htod_async(self.device_buffer.ptr, staging, stream)
+        copied.record(stream)
+    def get_async(self, stream, input_output_mode, shape=None):
         src = self.device_buffer
+        if shape is not None and tuple(shape) != self.shape:
+            # view of the leading elements of the max-shape buffer
+            src = pycuda.gpuarray.GPUArray(tuple(shape), self.dtype, gpudata=src.gpudata)
+        elif input_output_mode == 'torch_cuda':
+            return self.torch_buffer
         if input_output_mode == 'numpy':
             dst = self.host_buffer
+            if dst.shape != src.shape:
+                dst = dst.reshape(-1)[:src.size].reshape(src.shape)
             src.get_async(stream, dst)
         elif input_output_mode == 'torch_cuda':
             # Failed attempts: ctypes pointer conversion. Direct as_tensor. dtod memcpy (issue seems to be pytorch memory).
             output_arr = cuda.as_cuda_array(src)  # uses __cuda_array_interface__
-            output_arr = torch.as_tensor(output_arr, device='cuda')
+            output_arr = torch.as_tensor(output_arr, device=self.torch_device)
             return output_arr
         else:
             raise ValueError("Invalid input_output_mode: %s" % input_output_mode)
@@ -116,13 +246,54 @@ def squeeze_hw(x):
     elif x.shape[-1] == 1:
         x = x.reshape(x.shape[:-1])
     return x
+def shape_matches(trt_shape, shape):
+    """Whether shape fits an engine shape in which dynamic dimensions are -1."""
+    return len(trt_shape) == len(shape) and all(t == -1 or t == s for t, s in zip(trt_shape, shape))
+def select_profile(profiles, input_shapes):
+    """Index of the first optimization profile whose [min, max] ranges hold all input shapes.
+    Args:
+        profiles (list of dict): per profile, {input name: (min, opt, max)}
+        input_shapes (dict): {input name: shape}
+    """
+    for idx, profile in enumerate(profiles):
+        if all(all(lo <= dim <= hi for lo, dim, hi in zip(profile[name][0], shape, profile[name][2]))
+               for name, shape in input_shapes.items()):
+            return idx
+    raise ValueError("No optimization profile accepts input shapes %s. Profiles: %s" % (input_shapes, profiles))
+def _engine_profiles(trt_engine):
+    """{input name: (min, opt, max)} of the dynamic inputs, for every optimization profile of the engine."""
+    names = [trt_engine.get_tensor_name(i) for i in range(trt_engine.num_io_tensors)]
+    dynamic_inputs = [name for name in names
+                      if trt_engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT
+                      and -1 in tuple(trt_engine.get_tensor_shape(name))]
+    if not dynamic_inputs:
+        return []
+    return [{name: tuple(tuple(shape) for shape in trt_engine.get_tensor_profile_shape(name, idx))
+             for name in dynamic_inputs}
+            for idx in range(trt_engine.num_optimization_profiles)]
+def _max_tensor_shapes(trt_engine, profiles):
+    """Largest shape of every I/O tensor over all optimization profiles."""
+    names = [trt_engine.get_tensor_name(i) for i in range(trt_engine.num_io_tensors)]
+    max_shapes = {}
+    context = trt_engine.create_execution_context_without_device_memory()
+    stream = pycuda.driver.Stream()
+    for idx, profile in enumerate(profiles):
+        context.set_optimization_profile_async(idx, stream.handle)
+        stream.synchronize()
+        for name, (_, _, max_shape) in profile.items():
+            context.set_input_shape(name, max_shape)
+        for name in names:
+            shape = tuple(context.get_tensor_shape(name))
+            max_shapes[name] = tuple(max(a, b) for a, b in zip(max_shapes.get(name, shape), shape))
+    del context
+    return max_shapes
 def check_input_validity(input_idx, input_array, input_binding, input_output_mode):
     # Check shape
-    trt_shape = tuple(input_binding.shape)
+    trt_shape = tuple(input_binding.engine_shape)
     onnx_shape    = tuple(input_array.shape)
     gpu_ptr_copy_flag = False
     if onnx_shape != trt_shape:
-        if not (trt_shape == (1,) and onnx_shape == ()) :
+        if not shape_matches(trt_shape, onnx_shape) and not (trt_shape == (1,) and onnx_shape == ()) :
             raise ValueError("Wrong shape for input %i. Expected %s, got %s." %
                             (input_idx, trt_shape, onnx_shape))
     
@@ -151,10 +322,22 @@ def check_input_validity(input_idx, input_array, input_binding, input_output_mod
     else:
         raise ValueError("Invalid input_output_mode: %s" % input_output_mode)
     return input_array, gpu_ptr_copy_flag
-class Engine(object):
-    def __init__(self, trt_engine):
+# What enqueue needs to know about an input, resolved once per slot instead of on every call
+InputPlan = namedtuple('InputPlan', ['binding', 'shape', 'dtype', 'torch_dtype', 'nbytes', 'ptr', 'is_static'])
+def _input_plan(binding):
+    nbytes = int(np.prod(binding.shape)) * np.dtype(binding.dtype).itemsize
+    return InputPlan(binding, binding.engine_shape, binding.dtype, NP_TORCH_DTYPE_MAP.get(binding.dtype),
+                     nbytes, binding.device_buffer.ptr, not binding.is_dynamic)
+class ExecutionSlot(object):
+    """An execution context over a shared engine with its own stream and I/O buffers.
+    Requests on different slots can be in flight at the same time. Each slot holds its own
+    activation memory; the engine weights are shared.
+    """
+    def __init__(self, trt_engine, profiles=(), max_shapes=None, staging_depth=DEFAULT_STAGING_DEPTH,
+                 device_id=CUDA_DEVICE_ID):
         self.engine = trt_engine
-        bindings = [Binding(self.engine, i)
+        self.profiles = profiles
+        bindings = [Binding(self.engine, i, max_shapes, staging_depth, device_id)
                     for i in range(self.engine.num_io_tensors)]
         self.binding_addrs = [b.device_buffer.ptr for b in bindings]
         self.inputs  = [b for b in bindings if     b.is_input]
@@ -166,10 +349,59 @@ class Engine(object):
             _ = binding.host_buffer   # Force buffer allocation
         self.context = self.engine.create_execution_context()
         self.stream = pycuda.driver.Stream()
-    def __del__(self):
-        if self.engine is not None:
-            del self.engine
-    def run(self, inputs, input_output_mode):
+        self.done = pycuda.driver.Event()
+        self.handle = None # RunHandle of the request in flight, if any
+        # None until the first set_input_shapes: a context other than the engine's first one has no
+        # profile bound implicitly on TensorRT 8.x, so the first profile is always set explicitly
+        self.active_profile = None
+        self._input_shapes = None
+        self.input_plan = tuple(_input_plan(b) for b in self.inputs)
+        self.has_dynamic_inputs = any(b.is_dynamic for b in self.inputs)
+        self.shape_inference_inputs = tuple(i for i, b in enumerate(self.inputs)
+                                            if self.engine.is_shape_inference_io(b.name))
+        # tensor addresses only change when an IOBinding runs on this slot's context
+        self.addresses_bound = False
+        self.bind_addresses()
+        self.stage_profiler = None
+        self._stage_events = None
+        self._enqueue_time = None
+    def enable_profiling(self, stage_profiler, layer_profiler=None):
+        """Record the stage latencies of every request into stage_profiler, and the
+        per-layer times into layer_profiler if given."""
+        self.stage_profiler = stage_profiler
+        self._stage_events = (pycuda.driver.Event(), pycuda.driver.Event(), pycuda.driver.Event())
+        if layer_profiler is not None:
+            self.context.profiler = layer_profiler
+    def record_stages(self, synchronize_time):
+        start, copied_in, executed = self._stage_events
+        self.stage_profiler.record('h2d', copied_in.time_since(start))
+        self.stage_profiler.record('execute', executed.time_since(copied_in))
+        self.stage_profiler.record('d2h', self.done.time_since(executed))
+        self.stage_profiler.record('synchronize', synchronize_time * 1e3)
+        self.stage_profiler.record('total', (time.perf_counter() - self._enqueue_time) * 1e3)
+    def bind_addresses(self):
+        for i in range(self.engine.num_io_tensors):
+            self.context.set_tensor_address(self.engine.get_tensor_name(i), self.binding_addrs[i])
+        self.addresses_bound = True
+    def set_input_shapes(self, input_shapes, stream_handle=None):
+        """Select the optimization profile for the dynamic input shapes and set them on the context."""
+        if input_shapes == self._input_shapes:
+            return
+        profile = select_profile(self.profiles, input_shapes)
+        if profile != self.active_profile:
+            if not self.context.set_optimization_profile_async(
+                    profile, self.stream.handle if stream_handle is None else stream_handle):
+                raise RuntimeError("TensorRT rejected optimization profile %i for input shapes %s" %
+                                   (profile, input_shapes))
+            self.active_profile = profile
+        for name, shape in input_shapes.items():
+            self.context.set_input_shape(name, shape)
+        self._input_shapes = input_shapes
+    def enqueue(self, inputs, input_output_mode):
+        """Enqueue copies and execution on the slot's stream without waiting for them.
+        Returns:
+            list: output buffers, filled once the slot's done event has fired
+        """
         assert input_output_mode in ['torch_cuda', 'numpy']
         # len(inputs) > len(self.inputs) with Shape operator, input is never used
         # len(inputs) == len(self.inputs) for other operators
@@ -178,81 +410,577 @@ class Engine(object):
                              (len(self.inputs), len(inputs)))
         if isinstance(inputs, dict):
             inputs = [inputs[b.name] for b in self.inputs]
-        for i, (input_array, input_binding) in enumerate(zip(inputs, self.inputs)):
+        profiling = self.stage_profiler is not None
+        if profiling:
+            self._enqueue_time = time.perf_counter()
+            self._stage_events[0].record(self.stream)
+        dynamic_shapes = {}
+        torch_cuda = input_output_mode == 'torch_cuda'
+        for i, plan in enumerate(self.input_plan):
+            input_array = inputs[i]
+            # fast path: a static input of the expected shape and dtype is copied without further checks
+            if plan.is_static and input_array.shape == plan.shape:
+                if torch_cuda:
+                    if input_array.dtype is plan.torch_dtype and input_array.is_cuda and input_array.is_contiguous():
+                        pycuda.driver.memcpy_dtod_async(plan.ptr, input_array.data_ptr(), plan.nbytes, self.stream)
+                        continue
+                elif input_array.dtype == plan.dtype:
+                    plan.binding.stage_async(input_array, self.stream)
+                    continue
+            input_binding = plan.binding
             input_array, gpu_ptr_copy_flag = check_input_validity(i, input_array, input_binding, input_output_mode)
             input_binding_array = input_binding.device_buffer
+            if input_binding.is_dynamic:
+                dynamic_shapes[input_binding.name] = tuple(input_array.shape)
             if gpu_ptr_copy_flag:
-                pycuda.driver.memcpy_dtod_async(input_binding_array.ptr, input_array.data_ptr(), input_binding_array.nbytes, self.stream)
+                input_array = input_array.contiguous()
+                nbytes = input_array.numel() * input_array.element_size()
+                pycuda.driver.memcpy_dtod_async(input_binding_array.ptr, input_array.data_ptr(), nbytes, self.stream)
                 # this raises illegal memory access error in internal TRT engine.
                 # input_binding_array.gpudata = input_array.data_ptr()
             else:
-                input_binding_array.set_async(input_array, self.stream)
-        num_io = self.engine.num_io_tensors
-        for i in range(num_io):
-            tensor_name = self.engine.get_tensor_name(i)
-            if i < len(inputs) and self.engine.is_shape_inference_io(tensor_name):
-                self.context.set_tensor_address(tensor_name, inputs[i].ctypes.data)
-            else:
-                self.context.set_tensor_address(tensor_name, self.binding_addrs[i])
+                input_binding.stage_async(input_array, self.stream)
+        if dynamic_shapes:
+            self.set_input_shapes(dynamic_shapes)
+        if profiling:
+            self._stage_events[1].record(self.stream)
+        if not self.addresses_bound:
+            self.bind_addresses()
+        for i in self.shape_inference_inputs:
+            self.context.set_tensor_address(self.inputs[i].name, inputs[i].ctypes.data)
         self.context.execute_async_v3(self.stream.handle)
-        results = [output.get_async(self.stream, input_output_mode) for output in self.outputs]
-        self.stream.synchronize()
+        if profiling:
+            self._stage_events[2].record(self.stream)
+        results = [output.get_async(self.stream, input_output_mode,
+                                    self.context.get_tensor_shape(output.name) if output.is_dynamic else None)
+                   for output in self.outputs]
+        self.done.record(self.stream)
         return results
+class RunHandle(object):
+    """Handle of a request enqueued with Engine.run_async.
+    The outputs live in the slot's buffers and stay valid until the slot is reused,
+    i.e. until num_inflight further requests have been enqueued on the engine.
+    """
+    def __init__(self, slot, results, postprocess=None):
+        self._slot = slot
+        self._results = results
+        self._postprocess = postprocess
+        self._finished = False
+        self._synchronize_time = 0.0
+        self._profiled = slot.stage_profiler is None
+    def poll(self):
+        """Return True if the request has finished, without blocking."""
+        if not self._finished:
+            self._finished = self._slot.done.query()
+        return self._finished
+    def wait(self):
+        """Block until the request has finished and return its outputs."""
+        if not self._finished:
+            start = time.perf_counter()
+            self._slot.done.synchronize()
+            self._synchronize_time = time.perf_counter() - start
+            self._finished = True
+        if not self._profiled:
+            self._slot.record_stages(self._synchronize_time)
+            self._profiled = True
+        if self._postprocess is not None:
+            self._results = self._postprocess(self._results)
+            self._postprocess = None
+        return self._results
+    result = wait
+class Engine(object):
+    def __init__(self, trt_engine, num_inflight=1, staging_depth=DEFAULT_STAGING_DEPTH, device_id=CUDA_DEVICE_ID):
+        """Wrap a deserialized engine.
+        Args:
+            trt_engine (trt.ICudaEngine): TensorRT engine
+            num_inflight (int, optional): number of execution slots, i.e. how many run_async requests
+                can be in flight at once. Engines with dynamic inputs need TensorRT 10 for more than one,
+                see SHARED_PROFILES. Defaults to 1.
+            staging_depth (int, optional): page-locked staging buffers per input binding for numpy inputs. Defaults to 2.
+            device_id (int, optional): device of the engine, whose primary context must be current.
+                Defaults to CUDA_DEVICE_ID.
+        """
+        self.engine = trt_engine
+        self.staging_depth = staging_depth
+        self.device_id = device_id
+        self.profiles = _engine_profiles(self.engine)
+        if self.profiles and num_inflight > 1 and not SHARED_PROFILES:
+            raise ValueError("num_inflight > 1 over an engine with dynamic inputs needs TensorRT 10, "
+                             "found %s; build a static engine or use num_inflight=1" % trt.__version__)
+        self.max_shapes = _max_tensor_shapes(self.engine, self.profiles) if self.profiles else None
+        self._slots = [ExecutionSlot(self.engine, self.profiles, self.max_shapes, staging_depth, device_id)
+                       for _ in range(num_inflight)]
+        self._next_slot = 0
+        # the first slot also serves run_no_dma and IOBinding
+        slot = self._slots[0]
+        self.binding_addrs = slot.binding_addrs
+        self.inputs  = slot.inputs
+        self.outputs = slot.outputs
+        self.context = slot.context
+        self.stream = slot.stream
+    def __del__(self):
+        if self.engine is not None:
+            del self.engine
+    def run(self, inputs, input_output_mode):
+        return self.run_async(inputs, input_output_mode).wait()
+    def run_async(self, inputs, input_output_mode, postprocess=None):
+        """Enqueue a request on the next execution slot and return without waiting for it.
+        If that slot still has a request in flight, this waits for it first.
+        Args:
+            inputs: input arrays or tensors, as for run
+            input_output_mode (str): 'numpy' or 'torch_cuda'
+            postprocess (callable, optional): applied to the outputs by RunHandle.wait
+        Returns:
+            RunHandle: handle with poll() and wait()
+        """
+        slot = self._slots[self._next_slot]
+        self._next_slot = (self._next_slot + 1) % len(self._slots)
+        if slot.handle is not None:
+            slot.handle.wait()
+        results = slot.enqueue(inputs, input_output_mode)
+        slot.handle = RunHandle(slot, results, postprocess)
+        return slot.handle
+    def synchronize(self):
+        """Wait for every request in flight."""
+        for slot in self._slots:
+            if slot.handle is not None:
+                slot.handle.wait()
     def run_no_dma(self):
         self.context.execute_async_v3(self.stream.handle)
+    def enable_profiling(self, stage_profiler, layer_profiler=None):
+        """Instrument the execution slots behind run and run_async, see ExecutionSlot.enable_profiling."""
+        for slot in self._slots:
+            slot.enable_profiling(stage_profiler, layer_profiler)
+    def io_binding(self):
+        """Create an IOBinding that runs this engine directly on caller-owned tensors."""
+        return IOBinding(self)
+class LayerProfiler(trt.IProfiler):
+    """Accumulates the per-layer times TensorRT reports, in memory bounded by the number of layers.
+    One profiler may be attached to every context of an ExecutionContextPool, so TensorRT reports
+    from several threads; the lock serializes them.
+    """
+    def __init__(self):
+        trt.IProfiler.__init__(self)
+        self.layers = OrderedDict() # layer name -> [calls, total ms, max ms]
+        self._lock = threading.Lock()
+    def report_layer_time(self, layer_name, ms):
+        with self._lock:
+            entry = self.layers.get(layer_name)
+            if entry is None:
+                entry = self.layers[layer_name] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += ms
+            entry[2] = max(entry[2], ms)
+    def summary(self, top=None):
+        """Layers by total time, with their mean and max time per call and share of the total."""
+        with self._lock:
+            layers = [(name, list(entry)) for name, entry in self.layers.items()]
+        total = sum(entry[1] for _, entry in layers) or 1.0
+        layers = sorted(layers, key=lambda item: -item[1][1])[:top]
+        return [OrderedDict([('layer', name), ('calls', calls), ('mean_ms', total_ms / calls),
+                             ('max_ms', max_ms), ('share', total_ms / total)])
+                for name, (calls, total_ms, max_ms) in layers]
+    def report(self, top=20):
+        lines = ["  share   mean ms    max ms  layer"]
+        for layer in self.summary(top):
+            lines.append("%6.1f%%  %8.3f  %8.3f  %s" % (
+                layer['share'] * 100, layer['mean_ms'], layer['max_ms'], layer['layer']))
+        return "\n".join(lines)
+class ExecutionContextPool(object):
+    """A pool of execution slots over one engine for concurrent inference from several threads.
+    Each slot has its own execution context, stream and buffers, so threads never share
+    mutable state, while the engine weights are held in device memory only once.
+    Engines with dynamic inputs need TensorRT 10, where contexts can share an optimization profile;
+    before that, the engine's own context already holds the profiles, see SHARED_PROFILES.
+    """
+    def __init__(self, engine, size, timeout=None, postprocess=None):
+        """Create the pool.
+        Args:
+            engine (Engine): engine whose ICudaEngine the slots share
+            size (int): number of execution contexts
+            timeout (float, optional): default seconds to wait for a free context; None waits forever
+            postprocess (callable, optional): applied to the outputs returned by run
+        """
+        if engine.profiles and not SHARED_PROFILES:
+            raise ValueError("An ExecutionContextPool over an engine with dynamic inputs needs TensorRT 10, "
+                             "found %s; build a static engine or run it from one thread" % trt.__version__)
+        self.engine = engine
+        self.timeout = timeout
+        self._postprocess = postprocess
+        self._free = queue.Queue()
+        for _ in range(size):
+            self._free.put(ExecutionSlot(engine.engine, engine.profiles, engine.max_shapes, engine.staging_depth,
+                                         engine.device_id))
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Borrow an execution slot, making the CUDA context current for the calling thread.
+        Raises:
+            TimeoutError: if no slot is returned within the timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            slot = self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No execution context became free within %.3fs" % timeout)
+        try:
+            with cuda_context(self.engine.device_id):
+                yield slot
+        finally:
+            self._free.put(slot)
+    def run(self, inputs, input_output_mode, timeout=None):
+        """Run on a borrowed slot and wait for the outputs.
+        The outputs are copied out of the slot's buffers before the slot is returned to the pool.
+        """
+        with self.checkout(timeout) as slot:
+            results = slot.enqueue(inputs, input_output_mode)
+            slot.done.synchronize()
+            results = [result.clone() if isinstance(result, torch.Tensor) else result.copy() for result in results]
+        if self._postprocess is not None:
+            results = self._postprocess(results)
+        return results
+class IOBinding(object):
+    """Caller-owned torch CUDA tensors bound directly to engine inputs and outputs.
+    Tensors are validated once when they are bound; run() only sets the tensor addresses and
+    enqueues the engine, without copies or allocations. Outputs are written into the bound
+    tensors, so they stay valid until the caller reuses them. The binding shares the engine's
+    execution context, so it must not run concurrently with Engine.run.
+    Dynamic inputs may be bound at any shape accepted by an optimization profile.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.device_id = engine.device_id
+        self.slot = engine._slots[0]
+        self.context = self.slot.context
+        self._bindings = OrderedDict((b.name, b) for b in engine.inputs + engine.outputs)
+        self._tensors = OrderedDict()
+        self._addresses = None
+        self._input_shapes = {}
+    def bind(self, name, tensor):
+        """Bind a tensor to the engine input or output with the given name."""
+        if name not in self._bindings:
+            raise KeyError("Unknown tensor %s. Expected one of %s." % (name, list(self._bindings)))
+        binding = self._bindings[name]
+        if not isinstance(tensor, torch.Tensor) or not tensor.is_cuda:
+            raise TypeError("Tensor bound to %s must be a CUDA torch tensor." % name)
+        if tensor.device != binding.torch_device:
+            raise ValueError("Tensor bound to %s must be on %s, got %s." % (name, binding.torch_device, tensor.device))
+        if not tensor.is_contiguous():
+            raise ValueError("Tensor bound to %s must be contiguous." % name)
+        if not shape_matches(binding.engine_shape, tuple(tensor.shape)):
+            raise ValueError("Wrong shape for %s. Expected %s, got %s." %
+                             (name, binding.engine_shape, tuple(tensor.shape)))
+        if TORCH_NP_DTYPE_MAP.get(tensor.dtype) != binding.dtype:
+            raise TypeError("Wrong dtype for %s. Expected %s, got %s." %
+                            (name, binding.dtype, tensor.dtype))
+        self._tensors[name] = tensor
+        self._addresses = None
+        if binding.is_input and binding.is_dynamic:
+            self._input_shapes[name] = tuple(tensor.shape)
+        return tensor
+    def bind_input(self, name, tensor):
+        if not self._bindings[name].is_input:
+            raise ValueError("%s is an output of the engine." % name)
+        return self.bind(name, tensor)
+    def bind_output(self, name, tensor):
+        if self._bindings[name].is_input:
+            raise ValueError("%s is an input of the engine." % name)
+        return self.bind(name, tensor)
+    def allocate_outputs(self, device=None):
+        """Allocate and bind tensors for the outputs that are not bound yet.
+        Returns:
+            list of torch.Tensor: the output tensors, in engine output order
+        """
+        if self._input_shapes:
+            self.slot.set_input_shapes(dict(self._input_shapes))
+        for binding in self.engine.outputs:
+            if binding.name not in self._tensors:
+                shape = tuple(self.context.get_tensor_shape(binding.name)) if binding.is_dynamic else binding.shape
+                self.bind(binding.name, torch.empty(shape, dtype=NP_TORCH_DTYPE_MAP[binding.dtype],
+                                                    device=binding.torch_device if device is None else device))
+        return self.outputs
+    @property
+    def outputs(self):
+        return [self._tensors[b.name] for b in self.engine.outputs]
+    @_in_device_context
+    def run(self, stream=None):
+        """Enqueue the engine on the bound tensors.
+        Args:
+            stream (torch.cuda.Stream, optional): stream to run on. Defaults to torch's current stream,
+                so the engine is ordered after the kernels that produced the inputs.
+        Returns:
+            list of torch.Tensor: the bound output tensors, valid once the stream reaches this point
+        """
+        if stream is None:
+            stream = torch.cuda.current_stream(self.device_id)
+        if self._input_shapes:
+            self.slot.set_input_shapes(dict(self._input_shapes), stream.cuda_stream)
+        if self._addresses is None:
+            unbound = [name for name in self._bindings if name not in self._tensors]
+            if unbound:
+                raise ValueError("Tensors are not bound: %s" % unbound)
+            for binding in self.engine.outputs:
+                expected = tuple(self.context.get_tensor_shape(binding.name))
+                if tuple(self._tensors[binding.name].shape) != expected:
+                    raise ValueError("Wrong shape for %s. Expected %s, got %s." %
+                                     (binding.name, expected, tuple(self._tensors[binding.name].shape)))
+            self._addresses = [(name, tensor.data_ptr()) for name, tensor in self._tensors.items()]
+        self.slot.addresses_bound = False
+        for name, address in self._addresses:
+            self.context.set_tensor_address(name, address)
+        self.context.execute_async_v3(stream.cuda_stream)
+        return self.outputs
+PRECISIONS = (None, 'fp32', 'fp16', 'int8')
+REFIT_MAP_SUFFIX = '.refit.json'
+def _array_digest(array):
+    return hash_bytes(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+def _state_dict_arrays(state_dict):
+    return {key: value.detach().cpu().numpy() for key, value in state_dict.items()
+            if isinstance(value, torch.Tensor) and value.is_floating_point()}
+def build_refit_map(onnx_model, state_dict):
+    """Map the initializers of an ONNX model to the entries of the state dict it was exported from.
+    Initializers are matched by name, then by value, also transposed as the exporter does for MatMul weights.
+    Args:
+        onnx_model (onnx.ModelProto): exported model
+        state_dict (dict): the state dict the model was exported with
+    Returns:
+        dict: 'weights' maps initializer names to [state dict key, 'identity' or 'transpose'];
+            'baked' maps the state dict keys no initializer holds verbatim (e.g. folded into another
+            weight at export) to the digest of their exported value
+    """
+    state = _state_dict_arrays(state_dict)
+    by_value = {}
+    for key, value in state.items():
+        by_value.setdefault((value.shape, _array_digest(value)), []).append([key, 'identity'])
+        if value.ndim == 2:
+            by_value.setdefault((value.T.shape, _array_digest(value.T)), []).append([key, 'transpose'])
+    weights = OrderedDict()
+    for initializer in onnx_model.graph.initializer:
+        if initializer.data_type not in (onnx.TensorProto.FLOAT, onnx.TensorProto.FLOAT16):
+            continue
+        value = numpy_helper.to_array(initializer)
+        if initializer.name in state and state[initializer.name].shape == value.shape:
+            weights[initializer.name] = [initializer.name, 'identity']
+            continue
+        candidates = by_value.get((value.shape, _array_digest(value)), [])
+        # equal values of different parameters cannot be told apart; leave them to the baked check
+        if len(candidates) == 1:
+            weights[initializer.name] = candidates[0]
+    mapped = set(key for key, _ in weights.values())
+    baked = OrderedDict((key, _array_digest(value)) for key, value in state.items() if key not in mapped)
+    return {'weights': weights, 'baked': baked}
 class TensorRTBackendRep(BackendRep):
     """Wrapper for TensorRT backend rep."""
     def __init__(self, model, device,
                  max_workspace_size=None, serialize_engine=False, verbose=False,
-                 serialized_engine_path=None, int8_calibrator=None, **kwargs):
+                 serialized_engine_path=None, int8_calibrator=None,
+                 engine_cache_dir=None, max_engine_cache_size=None, num_inflight=1,
+                 optimization_profiles=None, precision=None, staging_depth=DEFAULT_STAGING_DEPTH,
+                 timing_cache_path=None, refittable=False, engine_path=None, **kwargs):
         """Initialize a TensorRT backend rep.
         Args:
-            model (onnx.ModelProto): ONNX model
+            model (onnx.ModelProto or str): ONNX model, or the path to it. A path is only loaded and
+                parsed when no serialized engine is found. May be None with engine_path.
             device (Device): device to run inference on
             max_workspace_size (int, optional): maximum workspace size. Defaults to None.
             serialize_engine (bool, optional): whether to serialize the engine. Defaults to False.
             verbose (bool, optional): whether to print verbose information. Defaults to False.
             serialized_engine_path (str, optional): path to serialized engine. Defaults to None.
+            int8_calibrator (trt.IInt8Calibrator, optional): enables INT8 on platforms with fast INT8,
+                e.g. maskclip_onnx.calibration.episode_calibrator. Defaults to None.
+            engine_cache_dir (str, optional): content-addressed engine cache directory. When set, engines are
+                looked up by ONNX hash, builder flags, workspace size, profiles and TensorRT version
+                instead of by serialized_engine_path. Defaults to None.
+            max_engine_cache_size (int, optional): engine cache size in bytes before LRU eviction. Defaults to 10 GiB.
+            num_inflight (int, optional): number of requests run_async can keep in flight. More than one
+                needs TensorRT 10 for engines with dynamic inputs. Defaults to 1.
+            optimization_profiles (dict or list of dict, optional): for models exported with dynamic axes,
+                one {input name: (min_shape, opt_shape, max_shape)} dict per optimization profile, e.g. a
+                batch-1 profile for the robot and a batch-64 profile for offline evaluation. Each call runs
+                on the first profile whose range holds the input shapes. Defaults to None.
+            precision (str, optional): 'fp32', 'fp16' or 'int8' (which needs int8_calibrator). Defaults to None,
+                which enables FP16, and INT8 when a calibrator is given, on platforms that run them fast.
+            staging_depth (int, optional): depth of the ring of page-locked buffers numpy inputs are staged
+                through before their asynchronous copy to the device. Defaults to 2.
+            timing_cache_path (str, optional): TensorRT timing cache file to seed builds with and merge their
+                tactic timings into. With engine_cache_dir the timing cache is kept in the engine cache
+                instead. Defaults to None.
+            refittable (bool, optional): build with the REFIT flag, so refit_from_state_dict can swap in the
+                weights of a new checkpoint without a rebuild. Defaults to False.
+            engine_path (str, optional): prebuilt serialized engine to load as is, e.g. the engine of a
+                build_engines.py manifest entry. Its I/O metadata is read from engine_path + '.json', from the
+                engine cache index when engine_path is a cache entry, or else from model. Defaults to None.
         """
+        start_time = time.perf_counter()
+        self.startup_times = OrderedDict()
         if not isinstance(device, Device):
             device = Device(device)
-        self._set_device(device)
-        self.serialized_engine_path = serialized_engine_path
-        if self.serialized_engine_path is not None:
-            assert serialize_engine
-        self._logger = TRT_LOGGER
+        # everything the rep allocates lives in the primary context of its device
+        with cuda_context(device.device_id):
+            self._set_device(device)
+            self.model_source = model
+            self.refittable = refittable
+            self._refit_map = None
+            self.serialized_engine_path = serialized_engine_path
+            if self.serialized_engine_path is not None:
+                assert serialize_engine
+            self._logger = TRT_LOGGER
+            if precision not in PRECISIONS:
+                raise ValueError("Unknown precision %s. Expected one of %s." % (precision, PRECISIONS))
+            if precision == 'int8' and int8_calibrator is None:
+                raise ValueError("precision='int8' needs an int8_calibrator, see maskclip_onnx.calibration")
+            self.precision = precision
+            self.int8_calibrator = int8_calibrator
+            self.serialize_engine = serialize_engine
+            self.verbose = verbose
+            if self.verbose:
+                TRT_LOGGER.min_severity = trt.Logger.VERBOSE
+            if max_workspace_size is None:
+                max_workspace_size = 1 << 28
+            self.max_workspace_size = max_workspace_size
+            self.num_inflight = num_inflight
+            self.staging_depth = staging_depth
+            self.timing_cache_path = timing_cache_path
+            self.optimization_profiles = _normalize_profiles(optimization_profiles)
+            self.builder = None
+            self.parser = None
+            self.shape_tensor_inputs = []
+            self.engine_cache = None
+            self.engine_cache_key = None
+            self.onnx_digest = None
+            self.stage_profiler = None
+            self.layer_profiler = None
+            # Fast path: a cached engine is deserialized together with the I/O metadata stored alongside it,
+            # without loading the ONNX model or creating a builder.
+            trt_blob, io_metadata = None, None
+            if engine_path is not None:
+                print("Loading engine {}".format(engine_path))
+                with self._timed('engine read'):
+                    with open(engine_path, 'rb') as f:
+                        trt_blob = f.read()
+                io_metadata = _read_io_metadata(engine_path + IO_METADATA_SUFFIX)
+                if io_metadata is None and engine_path.endswith(ENGINE_SUFFIX):
+                    cache = EngineCache(os.path.dirname(os.path.abspath(engine_path)))
+                    io_metadata = cache.metadata(os.path.basename(engine_path)[:-len(ENGINE_SUFFIX)])
+                if io_metadata is None and model is None:
+                    raise ValueError("No I/O metadata found for engine {}, pass the ONNX model too".format(engine_path))
+                if model is None and os.path.exists(io_metadata.get('onnx') or ''):
+                    # the ONNX model the engine was built from, needed by refit_from_state_dict
+                    self.model_source = io_metadata['onnx']
+            elif engine_cache_dir is not None:
+                self.engine_cache = EngineCache(engine_cache_dir, max_engine_cache_size)
+                with self._timed('digest'):
+                    if isinstance(model, six.string_types):
+                        self.onnx_digest = self.engine_cache.model_digest(model)
+                    else:
+                        self.onnx_digest = hash_bytes(model.SerializeToString())
+                    self.engine_cache_key = self._engine_cache_key(self.onnx_digest)
+                with self._timed('cache read'):
+                    trt_blob = self.engine_cache.get(self.engine_cache_key)
+                if trt_blob is not None:
+                    print("Loading cached engine {} from {}".format(self.engine_cache_key, self.engine_cache.cache_dir))
+                    io_metadata = self.engine_cache.metadata(self.engine_cache_key)
+            else:
+                # The legacy engine path depends on the precision flags, so the builder is needed to locate it.
+                with self._timed('builder'):
+                    self._create_builder()
+                if self.serialized_engine_path is not None and os.path.exists(self.serialized_engine_path):
+                    print("Loading serialized engine from {}".format(self.serialized_engine_path))
+                    with self._timed('engine read'):
+                        with open(self.serialized_engine_path, 'rb') as f:
+                            trt_blob = f.read()
+                    io_metadata = _read_io_metadata(self.serialized_engine_path + IO_METADATA_SUFFIX)
+            if trt_blob is not None:
+                with self._timed('deserialize'):
+                    self.runtime = trt.Runtime(TRT_LOGGER)
+                    self.engine = Engine(self.runtime.deserialize_cuda_engine(trt_blob), self.num_inflight,
+                                         self.staging_depth, self.device_id)
+                if io_metadata is None:
+                    # engine serialized before its I/O metadata was stored alongside it
+                    with self._timed('onnx load'):
+                        io_metadata = _io_metadata_from_model(self._load_model(model))
+            else:
+                with self._timed('onnx load'):
+                    model = self._load_model(model)
+                io_metadata = _io_metadata_from_model(model)
+                if self.builder is None:
+                    with self._timed('builder'):
+                        self._create_builder()
+                with self._timed('parse'):
+                    self._parse(model)
+                print("First time building engine. This may take a while... (up to 20 minutes)")
+                with self._timed('build'):
+                    self._build_engine(io_metadata=io_metadata)
+            self._output_shapes = {}
+            self._output_dtype = {}
+            for name, output in io_metadata['outputs'].items():
+                self._output_shapes[name] = tuple(output['shape'])
+                self._output_dtype[name] = output['elem_type']
+            self._compile_output_plan()
+            self.startup_times['total'] = time.perf_counter() - start_time
+            print(self.startup_report())
+    @contextmanager
+    def _timed(self, stage):
+        start = time.perf_counter()
+        yield
+        self.startup_times[stage] = self.startup_times.get(stage, 0.0) + time.perf_counter() - start
+    def startup_report(self):
+        """One-line summary of where the startup time went."""
+        stages = ", ".join("{} {:.3f}s".format(stage, seconds)
+                           for stage, seconds in self.startup_times.items() if stage != 'total')
+        return "Engine ready in {:.3f}s ({})".format(self.startup_times.get('total', 0.0), stages)
+    def _load_model(self, model):
+        if isinstance(model, six.string_types):
+            model = onnx.load(model)
+            onnx.checker.check_model(model)
+        return model
+    def _create_builder(self):
+        """Create the builder and its config, and select the precision."""
         # Fore more builder config options, see
         # https://docs.nvidia.com/deeplearning/tensorrt/api/python_api/infer/Core/Builder.html
         self.builder = trt.Builder(self._logger)
         self.config = self.builder.create_builder_config()
         # For more config options, see
         # https://docs.nvidia.com/deeplearning/tensorrt/api/python_api/infer/Core/BuilderConfig.html
-        self.int8_calibrator = int8_calibrator
-        if self.builder.platform_has_fast_fp16:
+        if self.precision is not None:
+            self._set_precision(self.precision)
+        elif self.builder.platform_has_fast_fp16:
             print("FAST FP16 detected. Enabling precision to FP16...")
-            self.serialized_engine_path = self.serialized_engine_path.replace('.trt', '_fp16.trt')
+            if self.serialized_engine_path is not None:
+                self.serialized_engine_path = self.serialized_engine_path.replace('.trt', '_fp16.trt')
             self.config.set_flag(trt.BuilderFlag.FP16)
-        # TODO(roger): enable INT8 requires post-training quantization and calibration
-        if self.builder.platform_has_fast_int8 and self.int8_calibrator is not None:
+        # INT8 needs a calibrator, see maskclip_onnx.calibration
+        if self.precision is None and self.builder.platform_has_fast_int8 and self.int8_calibrator is not None:
             print("FAST INT8 detected. Enabling INT8...")
-            self.serialized_engine_path = self.serialized_engine_path.replace('.trt', '_int8.trt')
+            if self.serialized_engine_path is not None:
+                self.serialized_engine_path = self.serialized_engine_path.replace('.trt', '_int8.trt')
             self.config.set_flag(trt.BuilderFlag.INT8)
             self.config.int8_calibrator = self.int8_calibrator
-            # TODO: where should this go?
-            # self.config.set_calibration_profile(profile)
+        if self.refittable:
+            self.config.set_flag(trt.BuilderFlag.REFIT)
+        self.config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, self.max_workspace_size)
+    def _set_precision(self, precision):
+        """Set the builder flags of an explicitly requested precision, regardless of what the platform runs fast."""
+        if precision == 'fp32':
+            return
+        if not self.builder.platform_has_fast_fp16:
+            print("Warning: FP16 requested on a platform without fast FP16")
+        # INT8 engines keep FP16 for the layers that have no INT8 implementation
+        self.config.set_flag(trt.BuilderFlag.FP16)
+        if precision == 'int8':
+            if not self.builder.platform_has_fast_int8:
+                print("Warning: INT8 requested on a platform without fast INT8")
+            self.config.set_flag(trt.BuilderFlag.INT8)
+            self.config.int8_calibrator = self.int8_calibrator
+        if self.serialized_engine_path is not None:
+            self.serialized_engine_path = self.serialized_engine_path.replace('.trt', '_{}.trt'.format(precision))
+    def _parse(self, model):
+        """Parse the ONNX model into a TensorRT network."""
         self.network = self.builder.create_network(flags=1 << (
             int)(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
         self.parser = trt.OnnxParser(self.network, self._logger)
-        self.shape_tensor_inputs = []
-        self.serialize_engine = serialize_engine
-        self.verbose = verbose
         if self.verbose:
             print(f'\nRunning {model.graph.name}...')
-            TRT_LOGGER.min_severity = trt.Logger.VERBOSE
-        if not isinstance(model, six.string_types):
-            model_str = model.SerializeToString()
-        else:
-            model_str = model
+        model_str = model.SerializeToString()
         if not trt.init_libnvinfer_plugins(TRT_LOGGER, ""):
             msg = "Failed to initialize TensorRT's plugin library."
             raise RuntimeError(msg)
@@ -263,36 +991,35 @@ class TensorRTBackendRep(BackendRep):
                     (error.file(), error.line(), error.func(),
                      error.code(), error.desc()))
             raise RuntimeError(msg)
-        if max_workspace_size is None:
-            max_workspace_size = 1 << 28
-        self.config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, max_workspace_size)
         if self.verbose:
             for layer in self.network:
                 print(layer)
             print(f'Output shape: {self.network[-1].get_output(0).shape}')
-        if os.path.exists(self.serialized_engine_path):
-            del self.parser
-            self.runtime = trt.Runtime(TRT_LOGGER)
-            print("Loading serialized engine from {}".format(self.serialized_engine_path))
-            with open(self.serialized_engine_path, 'rb') as f:
-                trt_engine = self.runtime.deserialize_cuda_engine(f.read())
-            self.engine = Engine(trt_engine)
-        else:
-            print("First time building engine. This may take a while... (up to 20 minutes)")
-            self._build_engine()
-        self._output_shapes = {}
-        self._output_dtype = {}
-        for output in model.graph.output:
-            dims = output.type.tensor_type.shape.dim
-            output_shape = tuple([dim.dim_value for dim in dims])
-            self._output_shapes[output.name] = output_shape
-            self._output_dtype[output.name] = output.type.tensor_type.elem_type
-    def _build_engine(self, inputs=None):
+    def _engine_cache_key(self, onnx_digest):
+        """Cache key of the engine built from the ONNX model with the given digest.
+        Uses the requested precision rather than the builder flags; those are a function of the
+        request and the GPU, which is part of the key, so no builder is needed to compute it.
+        """
+        int8 = self.int8_calibrator is not None
+        if int8 and hasattr(self.int8_calibrator, 'cache_digest'):
+            # engines built from different calibration caches differ
+            int8 = self.int8_calibrator.cache_digest() or True
+        builder_flags = {
+            'fp16': 'platform' if self.precision is None else self.precision != 'fp32',
+            'int8': int8 if self.precision in (None, 'int8') else False,
+        }
+        if self.refittable:
+            builder_flags['refit'] = True
+        device = "{} sm_{}{}".format(self.cuda_device.name(), *self.cuda_device.compute_capability())
+        return engine_cache_key(onnx_digest, builder_flags, self.max_workspace_size,
+                                self.optimization_profiles, trt.__version__, device)
+    def _build_engine(self, inputs=None, io_metadata=None):
         """Build a TensorRT engine with a builder config.
         Args:
             inputs(List of np.ndarray): inputs to the model; if not None,
                         this means we are building the engine at run time,
                         because we need to register optimization profiles for some inputs
+            io_metadata(dict): I/O metadata of the model, stored alongside the serialized engine
         """
         opt_profile = None
         if inputs:
@@ -312,18 +1039,91 @@ class TensorRTBackendRep(BackendRep):
                 elif -1 in inp_tensor.shape:
                     opt_profile.set_shape(name, inputs[i].shape, inputs[i].shape, inputs[i].shape)
             self.config.add_optimization_profile(opt_profile)
-        if self.int8_calibrator is not None:
+        for profile in self.optimization_profiles or []:
+            declared_profile = self.builder.create_optimization_profile()
+            for name, (min_shape, opt_shape, max_shape) in profile.items():
+                declared_profile.set_shape(name, min_shape, opt_shape, max_shape)
+            self.config.add_optimization_profile(declared_profile)
             if opt_profile is None:
-                opt_profile = self.builder.create_optimization_profile()
+                opt_profile = declared_profile
+        if self.int8_calibrator is not None and opt_profile is not None:
+            # dynamic networks are calibrated at the opt shapes of this profile
             self.config.set_calibration_profile(opt_profile)
+        timing_cache_bytes = self._attach_timing_cache()
+        build_start = time.perf_counter()
         trt_blob = self.builder.build_serialized_network(self.network, self.config)
         if trt_blob is None:
             raise RuntimeError("Failed to build TensorRT engine from network")
+        self._save_timing_cache(timing_cache_bytes, time.perf_counter() - build_start)
         
+        if self.engine_cache is not None:
+            if self.int8_calibrator is not None:
+                # a first INT8 build only writes the calibration cache while building; key the engine on
+                # that cache, as the next startup will, instead of on its absence
+                self.engine_cache_key = self._engine_cache_key(self.onnx_digest)
+            if io_metadata is not None and isinstance(self.model_source, six.string_types):
+                # lets a rep loaded from engine_path alone find the ONNX initializers a refit needs
+                io_metadata['onnx'] = os.path.abspath(self.model_source)
+            cached_path = self.engine_cache.put(self.engine_cache_key, trt_blob, metadata=io_metadata)
+            print("Engine {} written to the cache at {}".format(self.engine_cache_key, cached_path))
         trt_engine = self._deserialize(trt_blob)
         if self.serialize_engine:
             trt_engine = self._serialize_deserialize(trt_engine, self.serialized_engine_path)
-        self.engine = Engine(trt_engine)
+            if self.serialized_engine_path is not None and io_metadata is not None:
+                _write_io_metadata(self.serialized_engine_path + IO_METADATA_SUFFIX, io_metadata)
+        self.engine = Engine(trt_engine, self.num_inflight, self.staging_depth, self.device_id)
+    def _timing_cache_tag(self):
+        return "trt{}_sm{}{}".format(trt.__version__, *self.cuda_device.compute_capability())
+    def _attach_timing_cache(self):
+        """Seed the builder with the timing cache of earlier builds on this TensorRT version and GPU.
+        Returns:
+            int or None: size in bytes of the loaded timing cache, None when no timing cache is used
+        """
+        data = None
+        if self.engine_cache is not None:
+            data = self.engine_cache.read_timing_cache(self._timing_cache_tag())
+        elif self.timing_cache_path is not None and os.path.exists(self.timing_cache_path):
+            with open(self.timing_cache_path, 'rb') as f:
+                data = f.read()
+        if data is None and self.engine_cache is None and self.timing_cache_path is None:
+            return None
+        timing_cache = self.config.create_timing_cache(data or b'')
+        if not self.config.set_timing_cache(timing_cache, ignore_mismatch=False):
+            print("Timing cache does not match this TensorRT version or GPU, starting an empty one")
+            timing_cache = self.config.create_timing_cache(b'')
+            self.config.set_timing_cache(timing_cache, ignore_mismatch=False)
+            data = None
+        print("Timing cache loaded ({} bytes)".format(len(data or b'')))
+        return len(data or b'')
+    def _save_timing_cache(self, bytes_before, build_seconds):
+        """Merge the timing cache of this build into the stored one and report its growth and the build time.
+        TensorRT before 10 cannot list the cache entries, so the sizes are reported in bytes; a warm cache
+        shows up as a build that barely grows the cache and takes a fraction of the cold build time.
+        """
+        if self.engine_cache is None and self.timing_cache_path is None:
+            return
+        timing_cache = self.config.get_timing_cache()
+        # measured before merging in the tactics of concurrent builds
+        bytes_after = len(memoryview(timing_cache.serialize()))
+        print("Timing cache: {} bytes before, {} bytes after this build; built in {:.1f}s with a {} cache".format(
+            bytes_before, bytes_after, build_seconds, "warm" if bytes_before else "cold"))
+        def merge(existing):
+            # builds running concurrently may have stored tactics this build did not time
+            if existing:
+                timing_cache.combine(self.config.create_timing_cache(existing), False)
+            return bytes(memoryview(timing_cache.serialize()))
+        if self.engine_cache is not None:
+            self.engine_cache.update_timing_cache(self._timing_cache_tag(), merge)
+        else:
+            existing = None
+            if os.path.exists(self.timing_cache_path):
+                with open(self.timing_cache_path, 'rb') as f:
+                    existing = f.read()
+            data = merge(existing)
+            tmp_path = "{}.{}.tmp".format(self.timing_cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.timing_cache_path)
     def _set_device(self, device):
         """Set the device to the given device index.
         Args:
@@ -331,11 +1131,13 @@ class TensorRTBackendRep(BackendRep):
         """
         self.device = device
         assert (device.type == DeviceType.CUDA)
-        cudaSetDevice(device.device_id)
+        self.device_id = device.device_id
+        self.cuda_device = pycuda.driver.Device(self.device_id)
+        cudaSetDevice(self.device_id)
     
     def _deserialize(self, trt_blob):
         self.runtime = trt.Runtime(TRT_LOGGER)
-        del self.parser # Parser no longer needed for ownership of plugins
+        self.parser = None # Parser no longer needed for ownership of plugins
         trt_engine = self.runtime.deserialize_cuda_engine(trt_blob)
         return trt_engine
     def _serialize_deserialize(self, trt_engine, serialized_engine_path):
@@ -356,6 +1158,138 @@ class TensorRTBackendRep(BackendRep):
         trt_engine = self.runtime.deserialize_cuda_engine(
             serialized_engine)
         return trt_engine
+    def _check_source_model(self):
+        """The refit reads the initializers of the ONNX model the engine was built from."""
+        if self.model_source is None:
+            raise ValueError("refit needs the ONNX model the engine was built from; pass it to prepare together "
+                             "with engine_path")
+    def _refit_map_path(self):
+        if not isinstance(self.model_source, six.string_types):
+            return None
+        return self.model_source + REFIT_MAP_SUFFIX
+    def refit_map(self, reference_state_dict=None):
+        """Name map from ONNX initializers to state dict keys, see build_refit_map.
+        Computed from reference_state_dict, the checkpoint the ONNX model was exported from, and stored next to
+        the ONNX model; later calls read it back, so the reference is only needed once per export.
+        """
+        if self._refit_map is not None and reference_state_dict is None:
+            return self._refit_map
+        self._check_source_model()
+        path = self._refit_map_path()
+        if reference_state_dict is None:
+            if path is None or not os.path.exists(path):
+                raise ValueError("No refit map for this model yet: pass the state dict it was exported from "
+                                 "as reference_state_dict")
+            with open(path, 'r') as f:
+                self._refit_map = json.load(f, object_pairs_hook=OrderedDict)
+            return self._refit_map
+        self._refit_map = build_refit_map(self._load_model(self.model_source), reference_state_dict)
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(self._refit_map, f, indent=2)
+        return self._refit_map
+    @_in_device_context
+    def refit_from_state_dict(self, state_dict, reference_state_dict=None,
+                              verify_inputs=None, verify_outputs=None, atol=1e-3):
+        """Swap the weights of a new checkpoint into the engine in place, without rebuilding it.
+        Only the in-memory engine changes; cached and serialized engines keep the exported weights.
+        Requests in flight are waited for first; callers running the engine from other threads
+        (e.g. through a context pool) must not run it during the refit.
+        Args:
+            state_dict (dict): new state dict, with the keys of the one the ONNX model was exported from
+            reference_state_dict (dict, optional): the exported state dict, needed on the first refit
+                of an export to build the refit map, see refit_map
+            verify_inputs (list, optional): inputs run after the refit to verify it
+            verify_outputs (list of torch.Tensor or np.ndarray, optional): expected outputs for verify_inputs,
+                e.g. from the PyTorch policy with the new state dict
+            atol (float, optional): largest absolute error accepted by the verification. Defaults to 1e-3.
+        Returns:
+            dict: number of refitted weights, weights of the map the engine does not hold, and the
+                verification error if verify_inputs was given
+        Raises:
+            RuntimeError: if the engine is not refittable, a parameter that changed was folded into other
+                weights at export (the engine must be rebuilt), or the refit or its verification fails
+        """
+        if not self.engine.engine.refittable:
+            raise RuntimeError("The engine was not built with refittable=True")
+        refit_map = self.refit_map(reference_state_dict)
+        state = _state_dict_arrays(state_dict)
+        changed = [key for key, digest in refit_map['baked'].items()
+                   if key in state and _array_digest(state[key]) != digest]
+        if changed:
+            raise RuntimeError("These parameters changed but were folded into other weights at export, "
+                               "re-export and rebuild the engine: %s" % changed)
+        self.engine.synchronize()
+        refitter = trt.Refitter(self.engine.engine, TRT_LOGGER)
+        engine_weights = set(refitter.get_all_weights())
+        arrays = [] # the refitter reads the arrays during refit_cuda_engine
+        not_in_engine = []
+        for name, (key, transform) in refit_map['weights'].items():
+            if name not in engine_weights:
+                not_in_engine.append(name)
+                continue
+            value = state[key].T if transform == 'transpose' else state[key]
+            arrays.append(np.ascontiguousarray(value, dtype=np.float32))
+            refitter.set_named_weights(name, trt.Weights(arrays[-1]))
+        missing = refitter.get_missing_weights()
+        if missing:
+            # weights the engine combines with refitted ones; their exported values are still current
+            self._check_source_model()
+            initializers = {i.name: i for i in self._load_model(self.model_source).graph.initializer}
+            for name in missing:
+                if name not in initializers:
+                    raise RuntimeError("No value for the engine weight %s" % name)
+                arrays.append(np.ascontiguousarray(numpy_helper.to_array(initializers[name]), dtype=np.float32))
+                refitter.set_named_weights(name, trt.Weights(arrays[-1]))
+        if not refitter.refit_cuda_engine():
+            raise RuntimeError("Refitting the engine failed")
+        report = {'refitted': len(arrays), 'not_in_engine': not_in_engine}
+        if verify_inputs is not None:
+            outputs = self.run(verify_inputs, 'torch_cuda' if isinstance(verify_inputs[0], torch.Tensor) else 'numpy')
+            error = 0.0
+            for output, expected in zip(outputs, verify_outputs):
+                if isinstance(output, torch.Tensor):
+                    output = output.float().cpu().numpy()
+                if isinstance(expected, torch.Tensor):
+                    expected = expected.detach().float().cpu().numpy()
+                error = max(error, float(np.abs(output - expected).max()))
+            report['max_abs_err'] = error
+            if error > atol:
+                raise RuntimeError("Refitted engine differs from the reference outputs by %.3e (atol %.1e)" % (error, atol))
+        print("Refitted {} weights".format(report['refitted']))
+        return report
+    def io_binding(self):
+        """Create an IOBinding for zero-copy execution on caller-owned torch tensors."""
+        return self.engine.io_binding()
+    def thread_context(self):
+        """Context manager needed around calls from threads other than the one that imported this module."""
+        return cuda_context(self.device_id)
+    def enable_profiling(self, layers=False):
+        """Record the h2d, execute, d2h, synchronize and total time of every run into fixed-memory histograms.
+        Args:
+            layers (bool, optional): also collect per-layer times with a TensorRT IProfiler. This adds
+                synchronization between layers and inflates the stage times. Defaults to False.
+        Returns:
+            StageProfiler: the stage histograms, see report() and summary()
+        """
+        self.stage_profiler = StageProfiler()
+        self.layer_profiler = LayerProfiler() if layers else None
+        self.engine.enable_profiling(self.stage_profiler, self.layer_profiler)
+        return self.stage_profiler
+    def dump_profile(self, path):
+        """Write the stage percentiles and, if collected, the per-layer summary to a JSON file."""
+        if self.stage_profiler is None:
+            raise RuntimeError("Profiling is not enabled, call enable_profiling() first")
+        layers = self.layer_profiler.summary() if self.layer_profiler is not None else None
+        self.stage_profiler.dump(path, layers=layers)
+    @_in_device_context
+    def context_pool(self, size, timeout=None):
+        """Create an ExecutionContextPool of size contexts sharing this rep's engine.
+        Its run(inputs, input_output_mode) is thread-safe and returns the outputs as a named tuple.
+        Engines with dynamic inputs need TensorRT 10 for a pool.
+        """
+        return ExecutionContextPool(self.engine, size, timeout, postprocess=self._format_outputs)
+    @_in_device_context
     def run(self, inputs, input_output_mode='numpy', **kwargs):
         """Execute the prepared engine and return the outputs as a named tuple.
         Args:
@@ -365,44 +1299,87 @@ class TensorRTBackendRep(BackendRep):
         if isinstance(inputs, np.ndarray) or isinstance(inputs, torch.Tensor):
             inputs = [inputs]
         outputs = self.engine.run(inputs, input_output_mode)
+        return self._format_outputs(outputs)
+    @_in_device_context
+    def run_async(self, inputs, input_output_mode='numpy', **kwargs):
+        """Enqueue the prepared engine without waiting for it.
+        Up to num_inflight requests run concurrently, each on its own stream and buffers.
+        Args:
+            inputs -- Input tensor(s) as a Numpy array or list of Numpy arrays.
+            input_output_mode (str, optional): 'numpy' or 'torch_cuda'. Defaults to 'numpy'.
+        Returns:
+            RunHandle: poll() checks for completion, wait() blocks and returns the outputs as a named tuple
+        """
+        if isinstance(inputs, np.ndarray) or isinstance(inputs, torch.Tensor):
+            inputs = [inputs]
+        return self.engine.run_async(inputs, input_output_mode, postprocess=self._format_outputs)
+    def _compile_output_plan(self):
+        """Resolve once how the engine outputs map to the ONNX outputs: the named tuple type and
+        the outputs whose dtype or shape differ from what the ONNX model declares.
+        """
         output_names = [output.name for output in self.engine.outputs]
-        for i, (name, array) in enumerate(zip(output_names, outputs)):
-            output_shape = self._output_shapes[name]
+        self._outputs_type = namedtupledict('Outputs', output_names)
+        fixups = []
+        for i, binding in enumerate(self.engine.outputs):
+            output_dtype = self._output_dtype[binding.name]
             # HACK WAR for unknown output shape in run_node
-            if output_shape == (-99,):
-                # WAR for TRT requiring at least 2 dims (NC)
-                min_dims = 2
-                if _tensorrt_version()[0] < 4:
-                    # WAR for TRT only supporting 4D (NCHW) tensors
-                    min_dims = 4
-                if array.ndim == min_dims:
-                    npadding_dims = count_trailing_ones(array.shape)
-                    if npadding_dims > 0:
-                        outputs[i] = array.reshape(
-                            array.shape[:-npadding_dims])
-            else:
-                # HACK WAR replace fixed batch dim with variable
-                if self._output_dtype[name] == onnx.TensorProto.INT64:
-                    if array.dtype == np.int32:
-                        casted_output = np.array(outputs[i], dtype=np.int64)
-                        if np.equal(outputs[i], casted_output).all():
-                            outputs[i] = np.array(outputs[i], dtype=np.int64)
-                if self._output_dtype[name] == onnx.TensorProto.DOUBLE:
-                    if array.dtype == np.float32:
-                        casted_output = np.array(outputs[i], dtype=np.double)
-                        if np.equal(outputs[i], casted_output).all():
-                            outputs[i] = np.array(outputs[i], dtype=np.double)
-        outputs_tuple = namedtupledict('Outputs', output_names)(*outputs)
-        return namedtupledict('Outputs', output_names)(*outputs)
+            if self._output_shapes[binding.name] == (-99,):
+                fixups.append((i, None))
+            # TRT computes INT64 and DOUBLE outputs in INT32 and FLOAT; widening them back is exact
+            elif output_dtype == onnx.TensorProto.INT64 and binding.dtype == np.int32:
+                fixups.append((i, np.int64))
+            elif output_dtype == onnx.TensorProto.DOUBLE and binding.dtype == np.float32:
+                fixups.append((i, np.float64))
+        self._output_fixups = tuple(fixups)
+    def _format_outputs(self, outputs):
+        for i, dtype in self._output_fixups:
+            array = outputs[i]
+            if not isinstance(array, np.ndarray):
+                continue
+            if dtype is not None:
+                outputs[i] = array.astype(dtype)
+            # WAR for TRT requiring at least 2 dims (NC)
+            elif array.ndim == 2:
+                npadding_dims = count_trailing_ones(array.shape)
+                if npadding_dims > 0:
+                    outputs[i] = array.reshape(array.shape[:-npadding_dims])
+        return self._outputs_type(*outputs)
+    @_in_device_context
+    def measure_overhead(self, inputs, input_output_mode='numpy', iterations=1000, warmup=10):
+        """Host-side overhead of run(): its wall time per call minus the GPU time of the engine alone.
+        Returns:
+            dict: microseconds per call for 'run', 'engine' and 'overhead'
+        """
+        for _ in range(warmup):
+            self.run(inputs, input_output_mode)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            self.run(inputs, input_output_mode)
+        run_us = (time.perf_counter() - start_time) / iterations * 1e6
+        start, end = pycuda.driver.Event(), pycuda.driver.Event()
+        start.record(self.engine.stream)
+        for _ in range(iterations):
+            self.engine.run_no_dma()
+        end.record(self.engine.stream)
+        end.synchronize()
+        engine_us = end.time_since(start) / iterations * 1e3
+        overhead = {'run': run_us, 'engine': engine_us, 'overhead': run_us - engine_us}
+        print("run() {run:.1f} us/call, engine {engine:.1f} us, overhead {overhead:.1f} us".format(**overhead))
+        return overhead
 class TensorRTBackend(Backend):
     """TensorRT backend. Wrapper around ONNX backend."""
     @classmethod
     def prepare(cls, onnx_model_path, device='CUDA:0', **kwargs):
         """Build an engine from the given model.
+        Importing this module needs TensorRT, pycuda and a GPU; maskclip_onnx.providers.prepare is the
+        entry point that also runs on CPU-only hosts.
         Args:
             onnx_model_path (str): path to ONNX model
             device (str, optional): device to run inference on. Defaults to 'CUDA:0'.
         """
+        if kwargs.get('engine_cache_dir') is not None or kwargs.get('engine_path') is not None:
+            # Loaded and checked by the rep only when the engine cache misses or lacks I/O metadata
+            return TensorRTBackendRep(onnx_model_path, device, **kwargs)
         model = onnx.load(onnx_model_path)
         super(TensorRTBackend, cls).prepare(model, device, **kwargs)
         return TensorRTBackendRep(model, device, **kwargs)
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""Latency instrumentation for the inference backends.
+
+Latencies are recorded into fixed-memory histograms with log-spaced buckets,
+so profiling can stay enabled for a whole deployment without growing and
+still report tail percentiles. StageProfiler keeps one histogram per stage of
+a call (e.g. h2d, execute, d2h, synchronize, total):
+
+    profiler = rep.enable_profiling()
+    ...
+    print(profiler.report())
+    rep.dump_profile("profile.json")
+"""
+import json
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram(object):
+    def __init__(self, min_ms=1e-3, max_ms=1e4, buckets_per_decade=50):
+        """Create an empty histogram.
+        Args:
+            min_ms (float, optional): lower edge of the first bucket. Defaults to 1 us.
+            max_ms (float, optional): upper edge of the last bucket. Defaults to 10 s.
+            buckets_per_decade (int, optional): resolution; 50 bounds the percentile error to about 5%. Defaults to 50.
+        """
+        num_buckets = int(round(math.log10(max_ms / min_ms) * buckets_per_decade))
+        self.edges = np.logspace(math.log10(min_ms), math.log10(max_ms), num_buckets + 1)
+        # counts[0] holds samples below min_ms, counts[-1] samples at or above max_ms
+        self.counts = np.zeros(num_buckets + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, ms):
+        self.counts[np.searchsorted(self.edges, ms, side="right")] += 1
+        self.count += 1
+        self.total += ms
+        self.min = min(self.min, ms)
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-th percentile, clamped to the observed range."""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(q / 100.0 * self.count)))
+        idx = int(np.searchsorted(np.cumsum(self.counts), rank, side="left"))
+        if idx == 0:
+            return self.min
+        if idx == len(self.counts) - 1:
+            return self.max
+        return float(min(max(self.edges[idx], self.min), self.max))
+
+    def summary(self):
+        summary = OrderedDict([
+            ("count", self.count),
+            ("mean_ms", self.total / self.count if self.count else 0.0),
+            ("min_ms", self.min if self.count else 0.0),
+            ("max_ms", self.max),
+        ])
+        for q in PERCENTILES:
+            summary["p%i_ms" % q] = self.percentile(q)
+        return summary
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+
+class StageProfiler(object):
+    """
+    One LatencyHistogram per stage, created the first time a stage is recorded. Thread-safe, as the
+    slots of an ExecutionContextPool record into the same profiler from their worker threads.
+    """
+
+    def __init__(self, **histogram_kwargs):
+        self.histograms = OrderedDict()
+        self._histogram_kwargs = histogram_kwargs
+        self._lock = threading.Lock()
+
+    def record(self, stage, ms):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram(**self._histogram_kwargs)
+            histogram.record(ms)
+
+    def summary(self):
+        with self._lock:
+            return OrderedDict((stage, histogram.summary()) for stage, histogram in self.histograms.items())
+
+    def reset(self):
+        with self._lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+    def report(self):
+        lines = ["stage         count   mean ms    p50 ms    p95 ms    p99 ms    max ms"]
+        for stage, s in self.summary().items():
+            lines.append("%-12s %6i  %8.3f  %8.3f  %8.3f  %8.3f  %8.3f" % (
+                stage, s["count"], s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"]))
+        return "\n".join(lines)
+
+    def dump(self, path, **extra):
+        """Write the stage summary, plus any JSON-serializable extra sections, to a JSON file."""
+        data = OrderedDict([("stages", self.summary())])
+        data.update(extra)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
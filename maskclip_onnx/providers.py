@@ -0,0 +1,278 @@
+"""Execution providers behind the ``TensorRTBackendRep.run`` contract.
+
+Every provider exposes an engine object with ``inputs``/``outputs`` tensor
+specs and ``run(inputs, input_output_mode)`` returning a list of outputs, and
+is wrapped in a backend rep whose ``run`` returns the same named tuple as
+``TensorRTBackendRep.run``. ``prepare`` is the entry point for every call
+site: it only imports TensorRT for the tensorrt provider, so the serving code
+runs on hosts without TensorRT, pycuda or an NVIDIA driver:
+    - tensorrt: ``maskclip_onnx.onnx_tensorrt`` (imported lazily)
+    - onnxruntime: ONNX Runtime CPU execution provider with thread tuning
+    - torchscript: a ``torch.jit`` module on CPU or CUDA
+"""
+import contextlib
+import importlib.util
+import json
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import torch
+from onnx.backend.base import BackendRep, namedtupledict
+
+from maskclip_onnx.profiling import StageProfiler
+
+PROVIDERS = ("tensorrt", "onnxruntime", "torchscript")
+INPUT_OUTPUT_MODES = ("numpy", "torch_cuda")
+
+ORT_NP_DTYPE_MAP = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+    "tensor(int8)": np.int8,
+    "tensor(int16)": np.int16,
+    "tensor(int32)": np.int32,
+    "tensor(int64)": np.int64,
+    "tensor(uint8)": np.uint8,
+    "tensor(bool)": np.bool_,
+}
+
+# Extra file of a TorchScript module holding the input shapes and dtypes and the output names, see save_torchscript
+TORCHSCRIPT_IO_METADATA = "io_metadata.json"
+
+# Provider-agnostic description of an engine input or output. Dynamic dims are -1,
+# following the TensorRT convention used by ``onnx_tensorrt.Binding``.
+TensorSpec = namedtuple("TensorSpec", ["name", "shape", "dtype", "is_input"])
+
+
+def _static_shape(shape):
+    return tuple(dim if isinstance(dim, int) else -1 for dim in shape)
+
+
+def _order_inputs(inputs, input_specs):
+    if isinstance(inputs, dict):
+        return [inputs[spec.name] for spec in input_specs]
+    if len(inputs) < len(input_specs):
+        raise ValueError("Not enough inputs. Expected %i, got %i." % (len(input_specs), len(inputs)))
+    return list(inputs)
+
+
+class OnnxRuntimeEngine(object):
+    def __init__(self, model_path, intra_op_num_threads=None, inter_op_num_threads=None,
+                 parallel_execution=False, execution_providers=None):
+        """Create an ONNX Runtime session.
+        Args:
+            model_path (str): path to ONNX model
+            intra_op_num_threads (int, optional): threads used inside an operator. Defaults to ONNX Runtime's choice.
+            inter_op_num_threads (int, optional): threads used across operators when running in parallel mode.
+            parallel_execution (bool, optional): run independent graph branches in parallel. Defaults to False.
+            execution_providers (list, optional): ONNX Runtime providers. Defaults to ['CPUExecutionProvider'].
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            options.inter_op_num_threads = inter_op_num_threads
+        if parallel_execution:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        if execution_providers is None:
+            execution_providers = ["CPUExecutionProvider"]
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=execution_providers)
+        self.inputs = [TensorSpec(i.name, _static_shape(i.shape), ORT_NP_DTYPE_MAP[i.type], True)
+                       for i in self.session.get_inputs()]
+        self.outputs = [TensorSpec(o.name, _static_shape(o.shape), ORT_NP_DTYPE_MAP[o.type], False)
+                        for o in self.session.get_outputs()]
+        self._output_names = [o.name for o in self.outputs]
+
+    def run(self, inputs, input_output_mode):
+        assert input_output_mode in INPUT_OUTPUT_MODES
+        inputs = _order_inputs(inputs, self.inputs)
+        device = None
+        feed = {}
+        for spec, array in zip(self.inputs, inputs):
+            if input_output_mode == "torch_cuda":
+                device = array.device
+                array = array.detach().cpu().numpy()
+            feed[spec.name] = array
+        results = self.session.run(self._output_names, feed)
+        if input_output_mode == "torch_cuda":
+            results = [torch.from_numpy(result).to(device) for result in results]
+        return results
+
+
+def _np_dtype(torch_dtype):
+    return torch.empty(0, dtype=torch_dtype).numpy().dtype
+
+
+def save_torchscript(module, path, example_inputs, output_names=None):
+    """Save a scripted or traced module with the I/O metadata TorchScriptEngine reads at load time.
+    Args:
+        module (torch.jit.ScriptModule): module to save
+        path (str): output path
+        example_inputs (list of torch.Tensor): inputs in forward order, giving the input shapes and dtypes
+        output_names (list, optional): names of the outputs. Defaults to output_0, output_1, ...
+    """
+    input_names = [arg.name for arg in module.forward.schema.arguments[1:]]
+    metadata = {
+        "inputs": [{"name": name, "shape": list(array.shape), "dtype": _np_dtype(array.dtype).name}
+                   for name, array in zip(input_names, example_inputs)],
+        "output_names": output_names,
+    }
+    torch.jit.save(module, path, _extra_files={TORCHSCRIPT_IO_METADATA: json.dumps(metadata)})
+
+
+class TorchScriptEngine(object):
+    def __init__(self, model_path, device="cpu", num_threads=None, output_names=None, optimize=False,
+                 input_shapes=None, input_dtypes=None):
+        """Load a TorchScript module and describe its outputs with one dry run, as the other providers
+        describe theirs at load time.
+        Args:
+            model_path (str): path to a module saved with ``torch.jit.save``, preferably through
+                save_torchscript, which stores the input shapes and dtypes the dry run needs
+            device (str, optional): torch device to run on. Defaults to 'cpu'.
+            num_threads (int, optional): intra-op threads for CPU execution. Defaults to torch's choice.
+            output_names (list, optional): names of the outputs. Defaults to the saved names, else
+                output_0, output_1, ...
+            optimize (bool, optional): freeze and apply ``torch.jit.optimize_for_inference``. Defaults to False.
+            input_shapes (dict, optional): {input name: shape}, for modules saved without I/O metadata
+            input_dtypes (dict, optional): {input name: numpy dtype} with input_shapes. Defaults to float32.
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(device)
+        extra_files = {TORCHSCRIPT_IO_METADATA: ""}
+        module = torch.jit.load(model_path, map_location=self.device, _extra_files=extra_files).eval()
+        if optimize:
+            module = torch.jit.optimize_for_inference(torch.jit.freeze(module))
+        self.module = module
+        input_names = [arg.name for arg in module.forward.schema.arguments[1:]]
+        metadata = json.loads(extra_files[TORCHSCRIPT_IO_METADATA] or "{}")
+        if input_shapes is None and metadata.get("inputs"):
+            input_shapes = {spec["name"]: spec["shape"] for spec in metadata["inputs"]}
+            input_dtypes = {spec["name"]: spec["dtype"] for spec in metadata["inputs"]}
+        if input_shapes is None:
+            raise ValueError("%s has no I/O metadata: save it with save_torchscript or pass input_shapes" % model_path)
+        input_dtypes = input_dtypes or {}
+        self.inputs = [TensorSpec(name, tuple(input_shapes[name]), np.dtype(input_dtypes.get(name, np.float32)), True)
+                       for name in input_names]
+        dry_run = [torch.from_numpy(np.zeros(spec.shape, spec.dtype)).to(self.device) for spec in self.inputs]
+        with torch.inference_mode():
+            results = self._outputs(self.module(*dry_run))
+        output_names = output_names or metadata.get("output_names") or ["output_%i" % i for i in range(len(results))]
+        self.outputs = [TensorSpec(name, tuple(result.shape), _np_dtype(result.dtype), False)
+                        for name, result in zip(output_names, results)]
+
+    @staticmethod
+    def _outputs(results):
+        return [results] if isinstance(results, torch.Tensor) else list(results)
+
+    def run(self, inputs, input_output_mode):
+        assert input_output_mode in INPUT_OUTPUT_MODES
+        inputs = _order_inputs(inputs, self.inputs)
+        device = None
+        if input_output_mode == "torch_cuda":
+            device = inputs[0].device
+            inputs = [array.to(self.device, non_blocking=True) for array in inputs]
+        else:
+            inputs = [torch.from_numpy(np.ascontiguousarray(array)).to(self.device) for array in inputs]
+        with torch.inference_mode():
+            results = self._outputs(self.module(*inputs))
+        if input_output_mode == "torch_cuda":
+            return [result.to(device) for result in results]
+        return [result.cpu().numpy() for result in results]
+
+
+class ProviderBackendRep(BackendRep):
+    """Backend rep for the non-TensorRT providers."""
+
+    def __init__(self, engine, provider):
+        self.engine = engine
+        self.provider = provider
+        self.stage_profiler = None
+
+    def run(self, inputs, input_output_mode="numpy", **kwargs):
+        """Execute the engine and return the outputs as a named tuple.
+        Args:
+            inputs -- Input tensor(s) as a Numpy array / torch tensor or a list of them.
+            input_output_mode (str, optional): 'numpy' or 'torch_cuda'. 'torch_cuda' returns torch
+                tensors on the device of the inputs. Defaults to 'numpy'.
+        """
+        if isinstance(inputs, np.ndarray) or isinstance(inputs, torch.Tensor):
+            inputs = [inputs]
+        if self.stage_profiler is None:
+            outputs = self.engine.run(inputs, input_output_mode)
+        else:
+            start = time.perf_counter()
+            outputs = self.engine.run(inputs, input_output_mode)
+            self.stage_profiler.record("execute", (time.perf_counter() - start) * 1e3)
+        output_names = [output.name for output in self.engine.outputs]
+        return namedtupledict("Outputs", output_names)(*outputs)
+
+    def enable_profiling(self, layers=False):
+        """Record the wall-clock time of every run; mirrors TensorRTBackendRep.enable_profiling.
+        Copies happen inside the provider, so only the 'execute' stage is recorded and layers is ignored.
+        """
+        self.stage_profiler = StageProfiler()
+        return self.stage_profiler
+
+    def dump_profile(self, path):
+        if self.stage_profiler is None:
+            raise RuntimeError("Profiling is not enabled, call enable_profiling() first")
+        self.stage_profiler.dump(path, layers=None)
+
+    def thread_context(self):
+        """No per-thread setup is needed; mirrors TensorRTBackendRep.thread_context."""
+        return contextlib.nullcontext()
+
+
+def _torch_device(device):
+    """Map an ONNX device string ('CPU', 'CUDA:0') to a torch device string."""
+    if device is None:
+        return "cpu"
+    return str(device).lower()
+
+
+def available_providers():
+    """Providers usable on this host, fastest first."""
+    providers = []
+    if (importlib.util.find_spec("tensorrt") is not None and importlib.util.find_spec("pycuda") is not None
+            and torch.cuda.is_available()):
+        providers.append("tensorrt")
+    if importlib.util.find_spec("onnxruntime") is not None:
+        providers.append("onnxruntime")
+    providers.append("torchscript")
+    return providers
+
+
+def prepare(model_path, provider="auto", device=None, **kwargs):
+    """Prepare a backend rep for the given model on the requested provider.
+    Args:
+        model_path (str): path to an ONNX model (tensorrt, onnxruntime) or a TorchScript module (torchscript)
+        provider (str, optional): one of PROVIDERS, or 'auto' to pick the fastest available one. Defaults to 'auto'.
+        device (str, optional): device to run inference on, e.g. 'CUDA:0' or 'CPU'. Defaults to the provider's default.
+        **kwargs: provider specific options, see TensorRTBackendRep, OnnxRuntimeEngine and TorchScriptEngine.
+    Returns:
+        BackendRep: a rep whose ``run(inputs, input_output_mode)`` returns a named tuple of outputs
+    """
+    # model_path may be None for a tensorrt engine_path carrying its own I/O metadata
+    is_onnx = model_path is None or os.path.splitext(model_path)[1] == ".onnx"
+    if provider == "auto":
+        candidates = [p for p in available_providers() if (p == "torchscript") != is_onnx]
+        if not candidates:
+            raise RuntimeError("No available provider can load %s" % model_path)
+        provider = candidates[0]
+    if provider == "tensorrt":
+        from maskclip_onnx.onnx_tensorrt import TensorRTBackend
+
+        return TensorRTBackend.prepare(model_path, device=device or "CUDA:0", **kwargs)
+    if provider == "onnxruntime":
+        return ProviderBackendRep(OnnxRuntimeEngine(model_path, **kwargs), provider)
+    if provider == "torchscript":
+        if is_onnx:
+            raise ValueError("The torchscript provider needs a TorchScript module, got %s" % model_path)
+        return ProviderBackendRep(TorchScriptEngine(model_path, device=_torch_device(device), **kwargs), provider)
+    raise ValueError("Unknown provider %s. Expected one of %s or 'auto'." % (provider, PROVIDERS))